@@ -19,55 +19,189 @@ import os
 import subprocess
 import sys
 import cgi
+import cProfile
 import re
 import time
 import datetime
+import errno
+import gzip
+import hashlib
+import heapq
+import json
+import multiprocessing
+import shutil
+import tempfile
+import resource
+import signal
+import socket
+import stat
+import threading
+import traceback
+import SocketServer
+import BaseHTTPServer
+import SimpleHTTPServer
+import cPickle as pickle
 
 from optparse import OptionParser
+from cStringIO import StringIO
 
 from mako.template import Template
 from mako.lookup import TemplateLookup
 from mako.exceptions import TopLevelLookupException
 
 from parser import PContext
+from parser import Node
+from parser import Dispatcher
 from parser import remove_indent
 from parser import *
 
 from urllib import quote
 
-VERSION = ""
-HAPROXY_GIT_VERSION = False
+# Optional, to precompress the pages with brotli as well as gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
-def main():
-    global VERSION, HAPROXY_GIT_VERSION
+# Resolved before main() changes the working directory
+SCRIPT_FILE = os.path.abspath(__file__)
+# Last results of get_tool_version()
+TOOL_VERSIONS = {}
 
+def main():
     usage="Usage: %prog [options] file..."
 
     optparser = OptionParser(description='Generate HTML Document from HAProxy configuation.txt',
-                          version=VERSION,
                           usage=usage)
     optparser.add_option('--git-directory','-g', help='Optional git directory for input files, to determine haproxy details')
+    optparser.add_option('--revision','-r', help='Read the input files from this revision of the git directory, given as paths in the repository (ex: doc/configuration.txt), instead of the working tree')
     optparser.add_option('--output-directory','-o', default='.', help='Destination directory to store files, instead of the current working directory')
     optparser.add_option('--base','-b', default = '', help='Base directory for relative links')
+    optparser.add_option('--jobs','-j', type='int', default=1, help='Number of input files to convert in parallel')
+    optparser.add_option('--section-jobs', type='int', default=1, help='Number of processes parsing the sections of each file, when the files are not converted in parallel')
+    optparser.add_option('--cache-directory', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache'), help='Directory to keep data across runs (compiled templates, parsed sections), empty to disable')
+    optparser.add_option('--cache-max-age', type='int', default=30, metavar='DAYS', help='Remove the sections of the cache not used for this number of days, 0 to keep them')
+    optparser.add_option('--compact-anchors', action='store_true', default=False, help='Only write the anchor of each keyword, the other names leading to it being resolved by the page from a table of aliases')
+    optparser.add_option('--lazy-keywords', action='store_true', default=False, help='Render the keywords list of the sidebar in the browser, only the keywords in view being in the page')
+    optparser.add_option('--compress', action='store_true', default=False, help='Also write each page compressed with gzip, and with brotli when its python module is installed (.gz and .br files)')
+    optparser.add_option('--serve', metavar='SOCKET', help='Wait for conversion requests on this unix socket instead of converting files')
+    optparser.add_option('--stats', action='store_true', default=False, help='Report the time spent in each phase and parser, and the memory used')
+    optparser.add_option('--stats-json', metavar='FILE', help='Write the statistics to this file in JSON format, "-" for the standard output')
+    optparser.add_option('--profile', action='store_true', default=False, help='Report the matches of each parser and the slowest lines to parse')
+    optparser.add_option('--profile-stacks', metavar='FILE', help='Write the time spent in each phase, chapter and parser to this file, in the collapsed stacks format of flame graphs')
+    optparser.add_option('--profile-output', metavar='FILE', help='Write the cProfile statistics of the conversion to this file')
+    optparser.add_option('--watch','-w', action='store_true', default=False, help='Convert the files again each time they or the templates are modified')
+    optparser.add_option('--port','-p', type='int', default=8000, help='Port of the local preview server, reloading the pages once converted again, in watch mode (0 to disable)')
     (option, files) = optparser.parse_args()
 
-    if not files:
+    if not files and not option.serve:
         optparser.print_help()
         exit(1)
 
+    if option.revision and not option.git_directory:
+        optparser.error("--revision requires --git-directory")
+    if option.watch and option.revision:
+        optparser.error("--watch can't be used with --revision")
+    if (option.profile or option.profile_stacks or option.profile_output) and (option.watch or option.serve):
+        optparser.error("--profile options can't be used with --watch or --serve")
+
     option.output_directory = os.path.abspath(option.output_directory)
+    if option.watch:
+        files = [os.path.abspath(infile) for infile in files]
     if option.git_directory:
         option.git_directory = os.path.abspath(option.git_directory)
+    if option.cache_directory:
+        option.cache_directory = os.path.abspath(option.cache_directory)
+    if option.serve:
+        option.serve = os.path.abspath(option.serve)
+    if option.stats_json and option.stats_json != '-':
+        option.stats_json = os.path.abspath(option.stats_json)
+    stats = option.stats or bool(option.stats_json)
+    for name in ('profile_stacks', 'profile_output'):
+        if getattr(option, name):
+            setattr(option, name, os.path.abspath(getattr(option, name)))
+    profile = option.profile or bool(option.profile_stacks)
+    if option.profile_output and option.jobs > 1:
+        print >> sys.stderr, "The conversions are not done in parallel, to be profiled"
+        option.jobs = 1
+    if (profile or option.profile_output) and option.section_jobs > 1:
+        print >> sys.stderr, "The sections are not parsed in parallel, to be profiled"
+        option.section_jobs = 1
+    elif option.jobs > 1 and len(files) > 1 and option.section_jobs > 1:
+        print >> sys.stderr, "--section-jobs is ignored when the files are converted in parallel (--jobs)"
+        option.section_jobs = 1
 
     os.chdir(os.path.dirname(__file__))
 
-    VERSION = get_git_version()
-    if not VERSION:
+    version = get_git_version()
+    if not version:
         sys.exit(1)
 
-    HAPROXY_GIT_VERSION = get_haproxy_git_version(option.git_directory)
+    if option.cache_directory and option.cache_max_age > 0:
+        prune_cache(option.cache_directory, option.cache_max_age)
 
-    convert_all(files, option.output_directory, option.base)
+    # Settings of the pages, given the same way to each converter
+    options = {
+        'section_jobs': option.section_jobs,
+        'compress': option.compress,
+        'compact_anchors': option.compact_anchors,
+        'lazy_keywords': option.lazy_keywords,
+    }
+
+    if option.serve:
+        converter = Converter(version, get_haproxy_git_version(option.git_directory), cachedir=option.cache_directory, **options)
+        serve(option.serve, converter, option.git_directory)
+        return
+
+    if option.revision:
+        repository = GitRepository(option.git_directory)
+        try:
+            haproxy_version = repository.get_version(option.revision)
+            sources = {}
+            for infile in files:
+                sources[infile] = repository.read_file(option.revision, infile)
+                if sources[infile] is None:
+                    print >> sys.stderr, "Unable to find %s in revision %s" % (infile, option.revision)
+                    sys.exit(1)
+        finally:
+            repository.close()
+    else:
+        haproxy_version = get_haproxy_git_version(option.git_directory)
+        sources = None
+
+    converter = Converter(version, haproxy_version, option.base, option.cache_directory, stats, profile, **options)
+
+    if option.watch:
+        watch(converter, files, option.output_directory, option.jobs, option.port)
+        return
+
+    if option.profile_output:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    start = time.time()
+    converted = []
+    convert_all(converter, files, option.output_directory, option.jobs, sources, converted)
+
+    if option.profile_output:
+        profiler.disable()
+        profiler.dump_stats(option.profile_output)
+    if option.profile:
+        print_profile_report(get_profile_report(converted))
+    if option.profile_stacks:
+        with open(option.profile_stacks, 'w') as fd:
+            for stack, value in sorted(get_profile_stacks(converted).items()):
+                fd.write("%s %d\n" % (stack, value))
+    if stats:
+        report = get_stats_report(converted, time.time() - start, version)
+        if option.stats:
+            print_stats_report(report)
+        if option.stats_json == '-':
+            json.dump(report, sys.stdout, indent=1, sort_keys=True, separators=(',', ': '))
+            print
+        elif option.stats_json:
+            with open(option.stats_json, 'w') as fd:
+                json.dump(report, fd, indent=1, sort_keys=True, separators=(',', ': '))
 
 
 # Temporarily determine the version from git to follow which commit generated
@@ -106,6 +240,9 @@ def get_haproxy_git_version(path):
     if p.returncode != 0:
         return False
 
+    return parse_git_version(version)
+
+def parse_git_version(version):
     if len(version) < 2:
         return False
 
@@ -113,6 +250,73 @@ def get_haproxy_git_version(path):
     version = re.sub(r'-g.*', '', version)
     return version
 
+# Read files and versions from a git repository without checking them out :
+# objects are requested to one "git cat-file --batch" process for the whole
+# run, and the versions are described by git once per revision.
+class GitRepository:
+    def __init__(self, path):
+        self.path = path
+        self.process = subprocess.Popen(["git", "cat-file", "--batch"], cwd=path, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.versions = {}
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+    # Return the (sha1, type, content) of an object, given by any name git
+    # understands (ex: "v1.6.0:doc/configuration.txt"), or None
+    def read_object(self, name):
+        # One request per line : a line feed would leave an answer unread,
+        # and the next requests would get the previous objects
+        if "\n" in name:
+            raise ValueError("Invalid object name %r" % name)
+        self.process.stdin.write(name + "\n")
+        self.process.stdin.flush()
+        header = self.process.stdout.readline().rstrip("\n")
+        # "<name> missing" or "<name> ambiguous", the name can contain spaces
+        if header.endswith(" missing") or header.endswith(" ambiguous"):
+            return None
+        header = header.split()
+        if len(header) != 3:
+            return None
+        sha1, objtype, size = header
+        try:
+            size = int(size)
+        except ValueError:
+            return None
+        content = self.process.stdout.read(size)
+        self.process.stdout.read(1) # Trailing LF
+        return (sha1, objtype, content)
+
+    def read_file(self, revision, path):
+        found = self.read_object("%s:%s" % (revision, path))
+        if not found or found[1] != 'blob':
+            return None
+        return found[2]
+
+    # Return the output of "git describe --tags --match 'v*'" for a revision,
+    # or False
+    def describe(self, revision):
+        # Not to be taken as an option
+        if revision.startswith("-"):
+            return False
+        if not revision in self.versions:
+            try:
+                p = subprocess.Popen(["git", "describe", "--tags", "--match", "v*", revision], cwd=self.path, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            except EnvironmentError:
+                return False
+            version = p.communicate()[0].strip()
+            if p.returncode != 0:
+                version = False
+            self.versions[revision] = version
+        return self.versions[revision]
+
+    def get_version(self, revision):
+        version = self.describe(revision)
+        if not version:
+            return False
+        return parse_git_version(version)
+
 def getTitleDetails(string):
     array = string.split(".")
 
@@ -131,63 +335,229 @@ def getTitleDetails(string):
             "toplevel": toplevel
     }
 
-# Parse the whole document to insert links on keywords
-def createLinks():
-    global document, keywords, keywordsCount, keyword_conflicts, chapters
+# Build a regex matching exactly the given words, factored as a trie so that
+# thousands of alternatives can be tested in a single pass
+def trieRegex(words):
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = True
+    return _triePattern(trie) or '(?!)'
+
+def _triePattern(node):
+    alternatives = [re.escape(char) + _triePattern(node[char]) for char in sorted(node) if char]
+    if not alternatives:
+        return ''
+    if len(alternatives) == 1 and '' not in node:
+        return alternatives[0]
+    pattern = '(?:' + '|'.join(alternatives) + ')'
+    if '' in node:
+        pattern += '?'
+    return pattern
 
+# Parse the whole document to insert links on keywords
+#
+# The document is given as fragments (its sections), linked and yielded in
+# turn : a link never spans two fragments. The counters and the conflicts
+# list are updated once all of them were consumed.
+#
+# All keywords are matched in one left-to-right pass. The result is the same
+# as replacing each keyword in turn, in sorted order, with str.replace() :
+# - a closing &quot; can also open the next quoted keyword,
+# - two consecutive matches of the same rule can't share a delimiter,
+# - each keyword is linked before the short form of an "option" keyword that
+#   comes after it in the sorted order, and the other way round.
+def createLinks(fragments, keywords, keywordsCount, keyword_conflicts, chapters, aliases=None):
     print >> sys.stderr, "Generating keywords links..."
 
-    delimiters = [
-        dict(start='&quot;', end='&quot;', multi=True ),
-        dict(start='- '    , end='\n'    , multi=False),
-    ]
+    if aliases is None:
+        aliases = {}
 
+    # Links lead to the anchor written in the page for an alias
+    def target(name):
+        return quote(aliases.get(name, name))
+
+    keywordSet = set(keywords)
+    shortKeywords = {}
+    for keyword in keywords:
+        if keyword.startswith("option "):
+            shortKeywords[keyword[len("option "):]] = keyword
+
+    # Rules applying to each quoted token, in the order they are processed.
+    # A rule is identified by the keyword it links to and by its step in the
+    # keyword turn : 0 to link the keyword itself, 1 to count the short form
+    # of an "option" keyword and 2 to link it.
+    quoted = {}
+    for keyword in keywords:
+        quoted[keyword] = [(keyword, 0)]
+    for shortKeyword, keyword in shortKeywords.items():
+        quoted.setdefault(shortKeyword, []).append((keyword, 2))
+        quoted[shortKeyword].sort()
+
+    dropdowns = {}
+    for keyword in keyword_conflicts:
+        if quoted[keyword][0] != (keyword, 0):
+            # The conflict is dropped by the "option" keyword before being used
+            continue
+        chapter_list = ""
+        for chapter in keyword_conflicts[keyword]:
+            chapter_list += '<li><a href="#%s">%s</a></li>' % (target("%s (%s)" % (keyword, chapters[chapter]['title'])), chapters[chapter]['title'])
+        dropdowns[keyword] = ('<span class="dropdown">' +
+                '<a class="dropdown-toggle" data-toggle="dropdown" href="#">' +
+                keyword +
+                '<span class="caret"></span>' +
+                '</a>' +
+                '<ul class="dropdown-menu">' +
+                '<li class="dropdown-header">This keyword is available in sections :</li>' +
+                chapter_list +
+                '</ul>' +
+                '</span>')
+
+    pattern = re.compile('&quot;(%s)(?=&quot;)|- (%s)(?=\n)|- (%s)(?=- )' % (
+        trieRegex(quoted),
+        trieRegex(quoted),
+        trieRegex(shortKeywords),
+    ))
+
+    quotedCount = {}
+    dashCount = {}
+    shortDashCount = {}
+    for document in fragments:
+        # End of the previous quoted link for each token, with the index of the
+        # rule used : in a chain of shared delimiters, rules alternate.
+        lastQuoted = {}
+        # "- <option short form>- " is rewritten as "- <link>\n", which consumes
+        # the opening delimiter of the next keyword unless that one came first
+        chainEnd = None
+        chainRule = None
+        chunks = []
+        pos = 0
+        for match in pattern.finditer(document):
+            token, dashToken, dashShortToken = match.groups()
+            start = match.start()
+            if token is not None:
+                rules = quoted[token]
+                index = 0
+                if token in lastQuoted and lastQuoted[token][0] == start:
+                    # The opening delimiter was already used by the previous link
+                    index = lastQuoted[token][1] + 1
+                    if index >= len(rules):
+                        del lastQuoted[token]
+                        continue
+                lastQuoted[token] = (match.end(), index)
+                rule = rules[index]
+                quotedCount[token, rule] = quotedCount.get((token, rule), 0) + 1
+                keyword = rule[0]
+                if rule[1] == 0 and keyword in dropdowns:
+                    link = dropdowns[keyword]
+                else:
+                    link = '<a href="#' + target(keyword) + '">' + token + '</a>'
+                chunks.append(document[pos:start])
+                chunks.append('&quot;' + link)
+                pos = match.end()
+                continue
+
+            chained = (start == chainEnd)
+            chainEnd = None
+            if dashToken is not None:
+                if dashToken in shortKeywords:
+                    # Counted for the "option" keyword, even if not a keyword itself
+                    rule = (shortKeywords[dashToken], 1)
+                    if not chained or rule < chainRule:
+                        shortDashCount[dashToken] = shortDashCount.get(dashToken, 0) + 1
+                rule = (dashToken, 0)
+                if dashToken not in keywordSet or (chained and not rule < chainRule):
+                    continue
+                dashCount[dashToken] = dashCount.get(dashToken, 0) + 1
+                link = '<a href="#' + target(dashToken) + '">' + dashToken + '</a>'
+                end = match.end()
+            else:
+                rule = (shortKeywords[dashShortToken], 2)
+                if chained and not rule < chainRule:
+                    continue
+                link = '<a href="#' + target(rule[0]) + '">' + dashShortToken + '</a>\n'
+                chainEnd = match.end()
+                chainRule = rule
+                end = chainEnd + len('- ')
+            chunks.append(document[pos:start])
+            if not chained:
+                chunks.append('- ')
+            chunks.append(link)
+            pos = end
+        chunks.append(document[pos:])
+        yield "".join(chunks)
+
+    # Update the counters and the conflicts list in the keywords order
     for keyword in keywords:
-        keywordsCount[keyword] = 0
-        for delimiter in delimiters:
-            keywordsCount[keyword] += document.count(delimiter['start'] + keyword + delimiter['end'])
+        keywordsCount[keyword] = dashCount.get(keyword, 0) + quotedCount.get((keyword, (keyword, 0)), 0)
         if (keyword in keyword_conflicts) and (not keywordsCount[keyword]):
             # The keyword is never used, we can remove it from the conflicts list
             del keyword_conflicts[keyword]
-
-        if keyword in keyword_conflicts:
-            chapter_list = ""
-            for chapter in keyword_conflicts[keyword]:
-                chapter_list += '<li><a href="#%s">%s</a></li>' % (quote("%s (%s)" % (keyword, chapters[chapter]['title'])), chapters[chapter]['title'])
-            for delimiter in delimiters:
-                if delimiter['multi']:
-                    document = document.replace(delimiter['start'] + keyword + delimiter['end'],
-                            delimiter['start'] + '<span class="dropdown">' +
-                            '<a class="dropdown-toggle" data-toggle="dropdown" href="#">' +
-                            keyword +
-                            '<span class="caret"></span>' +
-                            '</a>' +
-                            '<ul class="dropdown-menu">' +
-                            '<li class="dropdown-header">This keyword is available in sections :</li>' +
-                            chapter_list +
-                            '</ul>' +
-                            '</span>' + delimiter['end'])
-                else:
-                    document = document.replace(delimiter['start'] + keyword + delimiter['end'], delimiter['start'] + '<a href="#' + quote(keyword) + '">' + keyword + '</a>' + delimiter['end'])
-        else:
-            for delimiter in delimiters:
-                document = document.replace(delimiter['start'] + keyword + delimiter['end'], delimiter['start'] + '<a href="#' + quote(keyword) + '">' + keyword + '</a>' + delimiter['end'])
         if keyword.startswith("option "):
             shortKeyword = keyword[len("option "):]
             keywordsCount[shortKeyword] = 0
-            for delimiter in delimiters:
-                keywordsCount[keyword] += document.count(delimiter['start'] + shortKeyword + delimiter['end'])
-            if (shortKeyword in keyword_conflicts) and (not keywordsCount[shortKeyword]):
-            # The keyword is never used, we can remove it from the conflicts list
+            keywordsCount[keyword] += quotedCount.get((shortKeyword, (keyword, 2)), 0)
+            if not (shortKeyword in keywordSet and shortKeyword < keyword):
+                keywordsCount[keyword] += shortDashCount.get(shortKeyword, 0)
+            if shortKeyword in keyword_conflicts:
+                # The keyword is never used, we can remove it from the conflicts list
                 del keyword_conflicts[shortKeyword]
-            for delimiter in delimiters:
-                document = document.replace(delimiter['start'] + shortKeyword + delimiter['start'], delimiter['start'] + '<a href="#' + quote(keyword) + '">' + shortKeyword + '</a>' + delimiter['end'])
 
-def documentAppend(text, retline = True):
-    global document
-    document += text
-    if retline:
-        document += "\n"
+# Collect the HTML of a document, section by section. When a spool file is
+# given, each finished section is moved to it, so that only the current one
+# is kept in memory.
+class DocumentBuilder:
+    def __init__(self, spool=None):
+        self.chunks = []
+        self.prepended = []
+        self.spool = spool
+        self.fragments = []
+
+    def append(self, text, retline = True):
+        self.chunks.append(text)
+        if retline:
+            self.chunks.append("\n")
+
+    def prepend(self, text):
+        self.prepended.insert(0, text)
+
+    # End the current fragment and return it
+    def flush(self):
+        if not self.chunks:
+            return ""
+        fragment = "".join(self.chunks)
+        self.chunks = []
+        if self.spool is None:
+            self.fragments.append(fragment)
+        else:
+            fragment = encode(fragment)
+            self.spool.write(fragment)
+            self.fragments.append(len(fragment))
+        return fragment
+
+    # Iterate over the fragments of the document, in order
+    def get_fragments(self):
+        for text in self.prepended:
+            yield text
+        if self.spool is None:
+            for fragment in self.fragments:
+                yield fragment
+        elif self.fragments:
+            self.spool.seek(0)
+            for length in self.fragments:
+                yield self.spool.read(length)
+        if self.chunks:
+            yield "".join(self.chunks)
+
+    def getvalue(self):
+        return "".join(self.get_fragments())
+
+def encode(text):
+    if isinstance(text, unicode):
+        return text.encode('utf-8')
+    return text
 
 def init_parsers(pctxt):
     return [
@@ -196,71 +566,1086 @@ def init_parsers(pctxt):
         seealso.Parser(pctxt),
         example.Parser(pctxt),
         table.Parser(pctxt),
-        underline.Parser(pctxt),
         keyword.Parser(pctxt),
     ]
 
 # The parser itself
 
-def convert_all(infiles, outdir, base=''):
-    converted = []
-    menu = []
-    for infile in infiles:
-        basefile = os.path.basename(infile).replace(".txt", ".html")
+# Templates are compiled to python modules stored in the cache directory, so
+# that they are only compiled again once modified
+def create_templates(cachedir=None):
+    if cachedir:
+        module_directory = os.path.join(cachedir, 'templates')
+    else:
+        module_directory = None
+    return TemplateLookup(
+        directories=[
+            'templates'
+        ],
+        module_directory=module_directory
+    )
+
+def listFiles(directory, extensions=('.html', '.tpl')):
+    paths = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if os.path.splitext(name)[1] in extensions:
+                paths.append(os.path.join(root, name))
+    return paths
+
+# Identify the converter and its templates, so that the cached sections are
+# parsed or rendered again once one of them is modified. The parsed sections
+# don't depend on the templates.
+# The files are read again when their modification time changes, as the
+# templates can be edited while a server is running.
+def get_tool_version(version, templates=True):
+    paths = [SCRIPT_FILE] + listFiles(os.path.join(os.path.dirname(SCRIPT_FILE), 'parser'), ('.py',))
+    if templates:
+        paths += listFiles('templates')
+    signature = [(version, None)] + [(path, os.path.getmtime(path)) for path in paths]
+    cached = TOOL_VERSIONS.get(templates)
+    if cached is None or cached[0] != signature:
+        digest = hashlib.sha1(version)
+        for path in paths:
+            with open(path, 'rb') as fd:
+                digest.update(path + '\0' + fd.read() + '\0')
+        # Replaced at once, for threads reading it at the same time
+        cached = TOOL_VERSIONS[templates] = (signature, digest.hexdigest())
+    return cached[1]
+
+# Sections already parsed or rendered by a previous run, keyed by a hash of
+# their raw text and of everything else they depend on. The parsed sections
+# are stored with the keywords they define, the rendered ones without their
+# links : the links are computed again on each run, from all the keywords of
+# the document.
+class SectionCache:
+    def __init__(self, cachedir, version):
+        self.directory = os.path.join(cachedir, 'sections')
+        self.parserVersion = get_tool_version(version, False)
+        self.version = get_tool_version(version)
+
+    # Key of a section, from the digest of its content, once parsed or once
+    # rendered
+    def key(self, pctxt, details, digest, rendered=True):
+        chapters = pctxt.chapters
+        if rendered:
+            context = (self.version, pctxt.context['base'], pctxt.context['compactAnchors'])
+        else:
+            context = (self.parserVersion, None, None)
+        return hashlib.sha1(repr(context + (
+            pctxt.context['headers'].get('subtitle'),
+            details['chapter'],
+            details['level'],
+            details['title'],
+            details['toplevel'],
+            chapters.get(details['chapter'], {}).get('title'),
+            chapters.get(details['toplevel'], {}).get('title'),
+            digest,
+        ))).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    # Return the value stored for a key, or None
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as fd:
+                value = pickle.load(fd)
+        except Exception:
+            return None
+        # Marks the entry as used, for prune_cache() to keep it
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return value
+
+    def put(self, key, value):
+        path = self.path(key)
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+        # Written aside then renamed, as several processes can share the cache
+        fd, tmpfile = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'wb') as tmp:
+            pickle.dump(value, tmp, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmpfile, path)
+
+# Each edited section adds new entries to the cache : remove the ones not used
+# for maxAge days. Return the number of entries removed.
+def prune_cache(cachedir, maxAge):
+    limit = time.time() - maxAge * 86400
+    removed = 0
+    for root, dirs, files in os.walk(os.path.join(cachedir, 'sections')):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                if os.path.getmtime(path) < limit:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                # Removed by another process
+                pass
+    return removed
+
+# Settings of the conversions : versions of the converter and of the
+# documented HAProxy, base of the relative links, cache directory and what to
+# measure. Each conversion keeps its state in its own parser context and
+# data, a converter can then be shared by threads.
+class Converter:
+    def __init__(self, version, haproxy_version=False, base='', cachedir=None, stats=False, profile=False, templates=None, section_jobs=1, compress=False, compact_anchors=False, lazy_keywords=False):
+        self.version = version
+        self.haproxy_version = haproxy_version
+        self.base = base
+        self.cachedir = cachedir
+        self.stats = stats
+        self.profile = profile
+        self.templates = templates
+        self.section_jobs = section_jobs
+        self.compress = compress
+        self.compact_anchors = compact_anchors
+        self.lazy_keywords = lazy_keywords
+
+    # The templates lookup can't be sent to the worker processes, they
+    # create their own one
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['templates'] = None
+        return state
+
+    # The settings of the pages, for the converters of other versions or
+    # bases to produce them the same way
+    def get_options(self):
+        return {
+            'section_jobs': self.section_jobs,
+            'compress': self.compress,
+            'compact_anchors': self.compact_anchors,
+            'lazy_keywords': self.lazy_keywords,
+        }
+
+    def get_templates(self):
+        if self.templates is None:
+            self.templates = create_templates(self.cachedir)
+        return self.templates
+
+    def get_cache(self):
+        # All the sections have to be parsed to be profiled
+        if not self.cachedir or self.profile:
+            return None
+        return SectionCache(self.cachedir, self.version)
+
+    def convert_file(self, infile, outdir, source=None, basefile=None):
+        if not basefile:
+            basefile = os.path.basename(infile).replace(".txt", ".html")
         outfile = os.path.join(
             outdir,
             basefile,
         )
-        pctxt = PContext(
-            TemplateLookup(
-                directories=[
-                    'templates'
-                ]
-            )
-        )
-        data = convert(pctxt, infile, outfile, base)
-        converted.append((outfile, data))
+        spool = tempfile.TemporaryFile()
+        try:
+            data = convert(self, PContext(self.get_templates()), infile, DocumentBuilder(spool), source)
+        finally:
+            spool.close()
+        return (basefile, outfile, data)
+
+    # Convert a document held in memory, its HTML being returned in the
+    # "document" entry of the data
+    def convert_text(self, text, name='configuration.txt'):
+        return convert(self, PContext(self.get_templates()), name, None, text)
+
+# Entry point of the worker processes started by convert_all()
+def convert_file_job(args):
+    converter, infile, outdir, source = args
+    # The compiled templates are shared through the cache directory
+    basefile, outfile, data = converter.convert_file(infile, outdir, source)
+    # The parser context holds the templates lookup, which can't be sent back
+    # to the parent process
+    del data['pctxt']
+    return (basefile, outfile, data)
+
+# sources optionally maps the input files to their content, when they were
+# not read from the working tree. The (basefile, outfile, data) of each file
+# are appended to the converted list when one is given.
+def convert_all(converter, infiles, outdir, jobs=1, sources=None, converted=None):
+    if sources is None:
+        sources = {}
+    if converted is None:
+        converted = []
 
-        menu.append((basefile, data['pctxt'].context['headers']['subtitle']))
+    try:
+        if jobs > 1 and len(infiles) > 1:
+            # Only the menu depends on all the files, each one can be parsed and
+            # linked in its own process
+            pool = multiprocessing.Pool(min(jobs, len(infiles)))
+            try:
+                results = [pool.apply_async(convert_file_job, ((converter, infile, outdir, sources.get(infile)),)) for infile in infiles]
+                collect_results(results, converted)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for infile in infiles:
+                converted.append(converter.convert_file(infile, outdir, sources.get(infile)))
+
+        changed = export_all(converter.get_templates(), converted, converter.cachedir, converter.compress)
+    finally:
+        remove_documents(converted)
+    print >> sys.stderr, "%d of %d file(s) changed" % (len(changed), len(converted))
+    return changed
+
+# Append the results of asynchronous calls to a list. All of them are
+# collected before the first error is raised, for the caller to clean up
+# after the successful ones.
+def collect_results(results, collected):
+    error = None
+    for result in results:
+        try:
+            collected.append(result.get())
+        except Exception:
+            if error is None:
+                error = sys.exc_info()
+    if error is not None:
+        raise error[0], error[1], error[2]
+
+# Remove the linked documents spooled by the conversions, once exported or
+# when the export is given up
+def remove_documents(converted):
+    for basefile, outfile, data in converted:
+        if data['document_file'] and os.path.exists(data['document_file']):
+            os.remove(data['document_file'])
+
+# Write the files converted together, with a menu linking them
+def export_all(templates, converted, cachedir=None, compress=False):
+    menu = []
+    for basefile, outfile, data in converted:
+        menu.append((basefile, data['headers']['subtitle']))
 
-    for item in converted:
-        outfile, data = item
-        data['menu'] = menu
+    if cachedir:
+        manifest = OutputManifest(cachedir)
+    else:
+        manifest = None
 
-        print >> sys.stderr, "Exporting to %s..." % outfile
-        template = pctxt.templates.get_template('template.html')
-        with open(outfile,'w') as fd:
-            print >> fd, template.render(**data)
+    changed = []
+    try:
+        for basefile, outfile, data in converted:
+            data['menu'] = menu
+
+            start = time.time()
+            template = templates.get_template('template.html')
+            if export(template, data, outfile, manifest, compress):
+                print >> sys.stderr, "Exported to %s" % outfile
+                changed.append(outfile)
+            else:
+                print >> sys.stderr, "%s is unchanged" % outfile
+            data['stats'].phase('export', start)
+            data['stats'].count('output size', os.path.getsize(outfile))
+    finally:
+        if manifest is not None:
+            manifest.save()
+
+    return changed
+
+# Hashes of the files written by previous runs, to leave them untouched when
+# their content is the same. A file modified or removed since then is
+# written again.
+class OutputManifest:
+    def __init__(self, cachedir):
+        self.path = os.path.join(cachedir, 'outputs.json')
+        try:
+            with open(self.path) as fd:
+                self.entries = json.load(fd)
+        except (IOError, ValueError):
+            self.entries = {}
+
+    def stat(self, outfile):
+        try:
+            st = os.stat(outfile)
+        except OSError:
+            return None
+        return [st.st_size, st.st_mtime]
+
+    def is_unchanged(self, outfile, digest):
+        entry = self.entries.get(os.path.abspath(outfile))
+        return entry is not None and entry == [digest] + (self.stat(outfile) or [])
+
+    def record(self, outfile, digest):
+        self.entries[os.path.abspath(outfile)] = [digest] + self.stat(outfile)
+
+    def forget(self, outfile):
+        self.entries.pop(os.path.abspath(outfile), None)
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, tmpfile = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w') as tmp:
+            json.dump(self.entries, tmp, indent=1, sort_keys=True, separators=(',', ': '))
+        os.rename(tmpfile, self.path)
+
+# Rendered in place of the document, which is then copied from its file
+DOCUMENT_MARKER = '<!-- haproxy-dconv:document -->'
+# Rendered in place of the conversion date, which is not a change by itself
+DATE_MARKER = '<!-- haproxy-dconv:date -->'
+
+# Extensions of all the compressed copies a page can have
+COMPRESSED_EXTENSIONS = ('.gz', '.br')
+
+# Extensions and encodings of the compressed copies of the pages
+def get_compressions():
+    compressions = [('.gz', 'gzip')]
+    if brotli is not None:
+        compressions.append(('.br', 'brotli'))
+    return compressions
+
+# Compressed copy of a page, written along the page itself. The gzip header
+# has neither a date nor a file name, for the same page to be compressed the
+# same way from one build to the next.
+class CompressedFile:
+    def __init__(self, path, encoding):
+        self.fd = open(path, 'wb')
+        self.encoding = encoding
+        if encoding == 'gzip':
+            self.compressor = gzip.GzipFile('', 'wb', 9, self.fd, 0)
+        else:
+            self.compressor = brotli.Compressor(mode=brotli.MODE_TEXT)
 
+    def write(self, data):
+        if self.encoding == 'gzip':
+            self.compressor.write(data)
+        else:
+            self.fd.write(self.compressor.process(data))
 
-def convert(pctxt, infile, outfile, base=''):
-    global document, keywords, keywordsCount, chapters, keyword_conflicts
+    def close(self):
+        if self.encoding == 'gzip':
+            self.compressor.close()
+        else:
+            self.fd.write(self.compressor.finish())
+        self.fd.close()
+
+# Write a page, and its compressed copies if required, unless the manifest
+# shows they are already up to date. Return True if the files were written.
+# The compressed copies which are not produced anymore are removed, not to be
+# served in place of the page.
+def export(template, data, outfile, manifest=None, compress=False):
+    values = dict(data, date=DATE_MARKER)
+    if data['document_file']:
+        values['document'] = DOCUMENT_MARKER
+        head, marker, tail = template.render(**values).partition(DOCUMENT_MARKER)
+    else:
+        head, marker, tail = (template.render(**values), '', '')
+    head = encode(head)
+    tail = encode(tail) + "\n" + data.get('trailer', '')
+
+    digest = hashlib.sha1(head)
+    if marker:
+        with open(data['document_file'], 'rb') as document:
+            for chunk in iter(lambda: document.read(65536), ''):
+                digest.update(chunk)
+    digest.update(tail)
+    digest = digest.hexdigest()
+
+    outfiles = [outfile]
+    if compress:
+        outfiles += [outfile + extension for extension, encoding in get_compressions()]
+    for path in [outfile + extension for extension in COMPRESSED_EXTENSIONS]:
+        if path in outfiles:
+            continue
+        if os.path.exists(path):
+            os.remove(path)
+        if manifest is not None:
+            manifest.forget(path)
+    if manifest is not None and all([manifest.is_unchanged(path, digest) for path in outfiles]):
+        return False
 
-    if len(base) > 0 and base[:-1] != '/':
-        base += '/'
+    # The page and its compressed copies are written in the same pass
+    fds = [open(outfile,'wb')]
+    try:
+        if compress:
+            for extension, encoding in get_compressions():
+                fds.append(CompressedFile(outfile + extension, encoding))
+        for fd in fds:
+            fd.write(head.replace(DATE_MARKER, data['date']))
+        if marker:
+            with open(data['document_file'], 'rb') as document:
+                for chunk in iter(lambda: document.read(65536), ''):
+                    for fd in fds:
+                        fd.write(chunk)
+        for fd in fds:
+            fd.write(tail.replace(DATE_MARKER, data['date']))
+    finally:
+        for fd in fds:
+            fd.close()
+    if manifest is not None:
+        for path in outfiles:
+            manifest.record(path, digest)
+    return True
+
+
+# Conversion server
+#
+# Clients connect to the unix socket and send one request per line, as a
+# JSON object with :
+# - "input"    : absolute path of the file to convert,
+#   or "text"  : the content to convert, with an optional "name" (the file
+#                name, "configuration.txt" by default),
+#   and with the server started with --git-directory, "revision" to read
+#   "input" from this revision of the repository,
+# - "base"     : optional, base directory for relative links,
+# - "output"   : optional, absolute path of the HTML file to write.
+# Each request is answered by a JSON object on one line, with "status" set
+# to "ok" or "error". On success, "changed" tells if the output file was
+# written, or "html" holds the page when no output was given. On error,
+# "message" explains why.
+#
+# The pages are produced with the options the server was started with
+# (--compress, --compact-anchors, --lazy-keywords...). Templates, sections
+# cache and versions are kept from one request to the next. The server has no
+# thread of its own : a connection is served until the client closes it, the
+# next ones waiting in the listen backlog, so the git process and the versions
+# shared by the requests need no lock.
+class ConversionHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            if not line.strip():
+                continue
+            try:
+                response = self.server.convert(json.loads(line))
+                response['status'] = 'ok'
+            except Exception, e:
+                print >> sys.stderr, "Request failed : %s" % e
+                response = {'status': 'error', 'message': str(e)}
+            self.wfile.write(json.dumps(response) + "\n")
+            self.wfile.flush()
+
+class ConversionServer(SocketServer.UnixStreamServer):
+    def __init__(self, path, converter, gitdir=None):
+        self.converter = converter
+        self.templates = converter.get_templates()
+        self.repository = None
+        self.versions = {}
+        if gitdir:
+            self.repository = GitRepository(gitdir)
+        # Only the current user can connect
+        umask = os.umask(0077)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, path, ConversionHandler)
+        finally:
+            os.umask(umask)
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        if self.repository:
+            self.repository.close()
+
+    def convert(self, request):
+        for key in request:
+            if isinstance(request[key], unicode):
+                request[key] = request[key].encode('utf-8')
+        output = request.get('output')
+        for key in ('input', 'output'):
+            if key == 'input' and request.get('revision'):
+                # A path in the repository
+                continue
+            if request.get(key) and not os.path.isabs(request[key]):
+                raise ValueError('"%s" must be an absolute path' % key)
+
+        version = self.converter.haproxy_version
+        if 'text' in request:
+            infile = request.get('name', 'configuration.txt')
+            source = request['text']
+        elif not 'input' in request:
+            raise ValueError('"input" or "text" is required')
+        elif request.get('revision'):
+            if not self.repository:
+                raise ValueError('"revision" requires a server started with --git-directory')
+            infile = request['input']
+            source = self.repository.read_file(request['revision'], infile)
+            if source is None:
+                raise ValueError('Unable to find %s in revision %s' % (infile, request['revision']))
+            if not request['revision'] in self.versions:
+                self.versions[request['revision']] = self.repository.get_version(request['revision'])
+            version = self.versions[request['revision']]
+        else:
+            infile = request['input']
+            source = None
+
+        converter = Converter(self.converter.version, version, request.get('base', ''), self.converter.cachedir, templates=self.templates, **self.converter.get_options())
+        if output:
+            outdir = os.path.dirname(output)
+            cachedir = converter.cachedir
+            compress = converter.compress
+        else:
+            # The page is only returned
+            outdir = tempfile.mkdtemp(prefix='haproxy-dconv-')
+            cachedir = None
+            compress = False
+        converted = []
+        try:
+            converted.append(converter.convert_file(infile, outdir, source, output and os.path.basename(output)))
+            changed = export_all(self.templates, converted, cachedir, compress)
+            if output:
+                return {'changed': bool(changed)}
+            with open(converted[0][1], 'rb') as fd:
+                return {'html': fd.read().decode('utf-8')}
+        finally:
+            remove_documents(converted)
+            if not output:
+                shutil.rmtree(outdir)
+
+def serve(path, converter, gitdir=None):
+    if os.path.exists(path):
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            print >> sys.stderr, "%s exists and is not a socket" % path
+            sys.exit(1)
+        # Only remove the socket left by a previous server, not one still
+        # waiting for requests
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.connect(path)
+        except socket.error as e:
+            if not e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+                raise
+            if os.path.exists(path):
+                os.remove(path)
+        else:
+            print >> sys.stderr, "A server is already waiting for requests on %s" % path
+            sys.exit(1)
+        finally:
+            client.close()
+    server = ConversionServer(path, converter, gitdir)
+    # Stop cleanly, removing the socket
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print >> sys.stderr, "Waiting for requests on %s..." % path
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+
+# Preview server of the watch mode. The pages are served from the output
+# directory, with the assets of the converter (css, images), and listen to
+# server-sent events to reload once converted again.
+RELOAD_SCRIPT = ('<script>new EventSource("/__events").onmessage = function(e) {'
+        ' if (e.data.split(" ").indexOf(location.pathname.split("/").pop()) != -1) location.reload();'
+        ' };</script>')
+
+class PreviewHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    def translate_path(self, path):
+        # The working directory is the converter one
+        assets = SimpleHTTPServer.SimpleHTTPRequestHandler.translate_path(self, path)
+        page = os.path.join(self.server.outdir, os.path.relpath(assets, os.getcwd()))
+        if os.path.exists(page):
+            return page
+        return assets
+
+    def do_GET(self):
+        if self.path == '/__events':
+            self.send_events()
+            return
+        path = self.translate_path(self.path)
+        if not path.endswith('.html') or not os.path.isfile(path):
+            SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+            return
+        with open(path, 'rb') as fd:
+            content = fd.read().replace('</body>', RELOAD_SCRIPT + '</body>', 1)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(content)
+
+    def send_events(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        server = self.server
+        generation = server.generation
+        try:
+            while True:
+                with server.converted:
+                    if server.generation == generation:
+                        server.converted.wait(15)
+                    if server.generation != generation:
+                        generation = server.generation
+                        event = "data: %s\n\n" % " ".join(server.pages)
+                    else:
+                        # Detects the closed connections
+                        event = ": keepalive\n\n"
+                self.wfile.write(event)
+                self.wfile.flush()
+        except socket.error:
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+class PreviewServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port, outdir):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), PreviewHandler)
+        self.outdir = outdir
+        self.generation = 0
+        self.pages = []
+        self.converted = threading.Condition()
+
+    # Tell the pages listening to events which ones changed
+    def notify(self, outfiles):
+        with self.converted:
+            self.generation += 1
+            self.pages = [os.path.basename(outfile) for outfile in outfiles]
+            self.converted.notify_all()
+
+# The files are polled, which is enough for a few of them. Thanks to the
+# sections cache, only the modified sections are parsed again.
+def watch(converter, infiles, outdir, jobs=1, port=0):
+    server = None
+    if port:
+        server = PreviewServer(port, outdir)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    mtimes = None
+    try:
+        while True:
+            paths = list(infiles) + listFiles('templates')
+            current = []
+            for path in paths:
+                try:
+                    current.append((path, os.path.getmtime(path)))
+                except OSError:
+                    current.append((path, None))
+            if current != mtimes:
+                mtimes = current
+                start = time.time()
+                try:
+                    changed = convert_all(converter, infiles, outdir, jobs)
+                except Exception:
+                    # The file may be in the middle of an edit, wait for the next one
+                    traceback.print_exc()
+                else:
+                    print >> sys.stderr, "Converted in %.2fs" % (time.time() - start)
+                    if server and changed:
+                        server.notify(changed)
+                if server:
+                    print >> sys.stderr, "Preview on http://127.0.0.1:%d/%s" % (port, os.path.basename(infiles[0]).replace(".txt", ".html"))
+                print >> sys.stderr, "Watching for changes..."
+            time.sleep(0.2)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if server:
+            server.shutdown()
+            server.server_close()
+
+# Timings and counters of a conversion
+class Stats:
+    def __init__(self):
+        self.phases = {}
+        self.parsers = {}
+        self.counters = {}
+
+    def add(self, table, name, elapsed, calls=1):
+        if not name in table:
+            table[name] = [0.0, 0]
+        table[name][0] += elapsed
+        table[name][1] += calls
+
+    # Account the time elapsed since start, and return the current time
+    def phase(self, name, start):
+        now = time.time()
+        self.add(self.phases, name, now - start)
+        return now
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def merge(self, other):
+        for table, others in ((self.phases, other.phases), (self.parsers, other.parsers)):
+            for name in others:
+                self.add(table, name, others[name][0], others[name][1])
+        for name in other.counters:
+            self.count(name, other.counters[name])
+
+    def get_values(self):
+        values = {'counters': dict(self.counters)}
+        for key, table in (('phases', self.phases), ('parsers', self.parsers)):
+            values[key] = {}
+            for name in table:
+                values[key][name] = {'time': round(table[name][0], 6), 'calls': table[name][1]}
+        return values
+
+# Stands for a parser, timing its calls. Only used with --stats, to leave
+# the conversion loop untouched otherwise.
+class TimedParser:
+    def __init__(self, parser, stats):
+        self.parser = parser
+        self.stats = stats
+        self.name = "%s.%s" % (parser.__class__.__module__, parser.__class__.__name__)
+        self.linePattern = parser.linePattern
+        self.nextLinePattern = parser.nextLinePattern
+
+    def parse(self, line):
+        start = time.time()
+        try:
+            return self.parser.parse(line)
+        finally:
+            self.stats.add(self.stats.parsers, self.name, time.time() - start)
+
+# Calls, matches and time of each parser in a file, with the slowest lines to
+# parse. A parser matches a line when it changes it, stops the other parsers
+# or consumes the next lines.
+class Profile:
+    def __init__(self, name, size=20):
+        self.name = name
+        self.size = size
+        self.parsers = {}
+        self.slowest = []
+        self.stacks = {}
+        self.begin_section({}, getTitleDetails(""), 1)
+
+    # Sections are profiled one after the other, line is the number of their
+    # first line in the file
+    def begin_section(self, chapters, details, line):
+        self.chapter = details["chapter"]
+        self.line = line
+        stack = ["parse"]
+        if self.chapter:
+            parts = self.chapter.split(".")
+            for level in xrange(1, len(parts) + 1):
+                chapter = ".".join(parts[:level])
+                if chapter in chapters:
+                    stack.append("%s. %s" % (chapter, chapters[chapter]["title"].replace(";", ",")))
+        self.stack = ";".join(stack) + ";"
+
+    def add(self, name, elapsed, matched, i, line):
+        if not name in self.parsers:
+            self.parsers[name] = [0, 0, 0.0]
+        entry = self.parsers[name]
+        entry[0] += 1
+        if matched:
+            entry[1] += 1
+        entry[2] += elapsed
+
+        stack = self.stack + name
+        self.stacks[stack] = self.stacks.get(stack, 0.0) + elapsed
+
+        if len(self.slowest) < self.size:
+            heapq.heappush(self.slowest, (elapsed, name, self.name, self.line + i, self.chapter, line[:80]))
+        elif elapsed > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (elapsed, name, self.name, self.line + i, self.chapter, line[:80]))
+
+# Stands for a parser when profiling, recording each call
+class ProfiledParser(TimedParser):
+    def __init__(self, parser, stats, profile):
+        TimedParser.__init__(self, parser, stats)
+        self.profile = profile
+
+    def parse(self, line):
+        pctxt = self.parser.pctxt
+        i = pctxt.i
+        start = time.time()
+        result = self.parser.parse(line)
+        elapsed = time.time() - start
+        self.stats.add(self.stats.parsers, self.name, elapsed)
+        self.profile.add(self.name, elapsed, result != line or pctxt.stop or pctxt.i != i, i, line)
+        return result
+
+def get_profile_report(converted):
+    parsers = {}
+    slowest = []
+    for basefile, outfile, data in converted:
+        profile = data['profile']
+        for name, (calls, matches, elapsed) in profile.parsers.items():
+            entry = parsers.setdefault(name, {'calls': 0, 'matches': 0, 'time': 0.0})
+            entry['calls'] += calls
+            entry['matches'] += matches
+            entry['time'] += elapsed
+        slowest.extend(profile.slowest)
+    return {
+        'parsers': parsers,
+        'slowest': heapq.nlargest(max([0] + [data['profile'].size for basefile, outfile, data in converted]), slowest),
+    }
+
+def print_profile_report(report):
+    print >> sys.stderr
+    print >> sys.stderr, "%-32s %10s %10s %10s %10s %10s" % ("Parser", "Calls", "Matches", "Misses", "Time (s)", "Call (us)")
+    for name, entry in sorted(report['parsers'].items(), key=lambda item: -item[1]['time']):
+        print >> sys.stderr, "%-32s %10d %10d %10d %10.3f %10.1f" % (name, entry['calls'], entry['matches'], entry['calls'] - entry['matches'], entry['time'], entry['time'] * 1000000 / max(1, entry['calls']))
+    print >> sys.stderr
+    print >> sys.stderr, "Slowest lines :"
+    for elapsed, name, infile, lineno, chapter, line in report['slowest']:
+        # The lines are parsed once escaped, with links to the sections
+        line = re.sub(r'<[^>]*(>|$)', '', line)
+        line = line.replace('&lt;', '<').replace('&gt;', '>').replace('&quot;', '"').replace('&amp;', '&')
+        print >> sys.stderr, "%8.3fms %-24s %s:%d (%s) %s" % (elapsed * 1000, name, infile, lineno, chapter or "-", line.strip())
+
+# Time in microseconds per phase, chapter and parser, as "a;b;c value" lines.
+# The time of the parse phase outside of the parsers is reported on its own.
+def get_profile_stacks(converted):
+    stacks = {}
+    for basefile, outfile, data in converted:
+        profile = data['profile']
+        prefix = profile.name.replace(";", ",") + ";"
+        phases = data['stats'].phases
+        parsing = 0.0
+        for stack, elapsed in profile.stacks.items():
+            stacks[prefix + stack] = stacks.get(prefix + stack, 0) + int(elapsed * 1000000)
+            parsing += elapsed
+        for name in phases:
+            elapsed = phases[name][0]
+            if name == 'parse':
+                elapsed = max(0.0, elapsed - parsing)
+            stacks[prefix + name] = stacks.get(prefix + name, 0) + int(elapsed * 1000000)
+    return stacks
+
+def get_stats_report(converted, elapsed, version):
+    total = Stats()
+    files = {}
+    for basefile, outfile, data in converted:
+        files[outfile] = data['stats'].get_values()
+        total.merge(data['stats'])
+    report = total.get_values()
+    report['files'] = files
+    report['time'] = round(elapsed, 6)
+    report['version'] = version
+    # In kilobytes on Linux. tracemalloc isn't available in python 2, the
+    # peak resident size is the closest measure.
+    report['peak memory'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    report['workers peak memory'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return report
+
+def print_stats_report(report):
+    print >> sys.stderr
+    print >> sys.stderr, "%-32s %10s %10s" % ("Phase", "Calls", "Time (s)")
+    for table in ('phases', 'parsers'):
+        for name, entry in sorted(report[table].items(), key=lambda item: -item[1]['time']):
+            print >> sys.stderr, "%-32s %10d %10.3f" % (name, entry['calls'], entry['time'])
+        print >> sys.stderr
+    for name in sorted(report['counters']):
+        print >> sys.stderr, "%-32s %10d" % (name, report['counters'][name])
+    print >> sys.stderr, "%-32s %10d" % ("peak memory (KB)", report['peak memory'])
+    if report['workers peak memory']:
+        print >> sys.stderr, "%-32s %10d" % ("workers peak memory (KB)", report['workers peak memory'])
+    print >> sys.stderr, "%-32s %21.3f" % ("total time (s)", report['time'])
+
+def mergeKeywords(keywords, sectionKeywords):
+    for keyword in sectionKeywords:
+        if not keyword in keywords:
+            keywords[keyword] = set()
+        keywords[keyword].update(sectionKeywords[keyword])
+
+# Escape the raw text of a section, before it is parsed
+def escape_section(content):
+    content = cgi.escape(content, True)
+    return re.sub(r'section ([0-9]+(.[0-9]+)*)', r'<a href="#\1">section \1</a>', content)
+
+# Read the headers at the beginning of the current content, return True when
+# the document has a header
+def parse_headers(pctxt):
+    pctxt.context['headers'] = {
+        'title':    '',
+        'subtitle': '',
+        'version':  '',
+        'author':   '',
+        'date':     ''
+    }
+    if re.match("^-+$", pctxt.get_line().strip()):
+        # Try to analyze the header of the file, assuming it follows
+        # those rules :
+        # - it begins with a "separator line" (several '-' chars)
+        # - then the document title
+        # - an optional subtitle
+        # - a new separator line
+        # - the version
+        # - the author
+        # - the date
+        pctxt.next()
+        pctxt.context['headers']['title'] = pctxt.get_line().strip()
+        pctxt.next()
+        subtitle = ""
+        while not re.match("^-+$", pctxt.get_line().strip()):
+            subtitle += " " + pctxt.get_line().strip()
+            pctxt.next()
+        pctxt.context['headers']['subtitle'] += subtitle.strip()
+        if not pctxt.context['headers']['subtitle']:
+            # No subtitle, try to guess one from the title if it
+            # starts with the word "HAProxy"
+            if pctxt.context['headers']['title'].startswith('HAProxy '):
+                pctxt.context['headers']['subtitle'] = pctxt.context['headers']['title'][8:]
+                pctxt.context['headers']['title'] = 'HAProxy'
+        pctxt.next()
+        pctxt.context['headers']['version'] = pctxt.get_line().strip()
+        pctxt.next()
+        pctxt.context['headers']['author'] = pctxt.get_line().strip()
+        pctxt.next()
+        pctxt.context['headers']['date'] = pctxt.get_line().strip()
+        pctxt.next()
+
+        # Skip header lines
+        pctxt.eat_lines()
+        pctxt.eat_empty_lines()
+        return True
+    return False
+
+# Parse the current content into a list of HTML strings and nodes
+def parse_lines(pctxt, dispatcher):
+    items = []
+    delay = []
+    while pctxt.has_more_lines():
+        line = pctxt.get_line()
+
+        oldline = line
+        pctxt.stop = False
+        for parser in dispatcher.get_parsers():
+            line = parser.parse(line)
+            if pctxt.stop:
+                break
+        if oldline == line:
+            # nothing has changed,
+            # delays the rendering
+            if delay or line != "":
+                delay.append(line)
+            pctxt.next()
+        elif pctxt.stop:
+            while delay and delay[-1].strip() == "":
+                del delay[-1]
+            if delay:
+                remove_indent(delay)
+                items.append(Node('text', lines=delay))
+            delay = []
+            items.append(line)
+        else:
+            while delay and delay[-1].strip() == "":
+                del delay[-1]
+            if delay:
+                remove_indent(delay)
+                items.append(Node('text', lines=delay))
+            delay = []
+            items.append(line)
+            items.append("\n")
+            pctxt.next()
+
+    while delay and delay[-1].strip() == "":
+        del delay[-1]
+    if delay:
+        remove_indent(delay)
+        items.append(Node('text', lines=delay))
+    return items
+
+# Entry point of the worker processes started by parse_document(). The
+# sections only share the chapters and the headers, each one collects the
+# keywords it defines.
+def parse_sections_job(args):
+    converter, chapters, headers, sections = args
+    stats = Stats()
+    # The compiled templates are shared through the cache directory
+    pctxt = PContext(converter.get_templates())
+    pctxt.context = {
+            'headers':  headers,
+            'document': "",
+    }
+    pctxt.keywordsCount = {}
+    pctxt.chapters = chapters
+    parsers = init_parsers(pctxt)
+    if converter.stats:
+        parsers = [TimedParser(parser, stats) for parser in parsers]
+    dispatcher = Dispatcher(pctxt, parsers)
+
+    parsed = []
+    for details, content in sections:
+        pctxt.details = details
+        pctxt.keywords = {}
+        pctxt.set_content(escape_section(content))
+        parsed.append((parse_lines(pctxt, dispatcher), pctxt.keywords))
+    return (parsed, stats)
+
+# Split the sections to parse into batches of about the same size, several
+# per process for the largest sections not to hold the others back
+def split_sections(sections, jobs):
+    size = sum([len(content) for parsed, content, key in sections]) / (jobs * 4) + 1
+    batches = [[]]
+    length = 0
+    for section in sections:
+        if length >= size:
+            batches.append([])
+            length = 0
+        batches[-1].append(section)
+        length += len(section[1])
+    return batches
+
+# Convert a document, which is parsed then rendered
+def convert(converter, pctxt, infile, output=None, source=None):
+    stats = Stats()
+    profile = None
+    if converter.profile:
+        profile = Profile(os.path.basename(infile))
+    tree = parse_document(converter, pctxt, infile, source, stats, profile)
+    data = render_document(converter, pctxt, tree, output, stats)
+    data['profile'] = profile
+    return data
+
+# Parse a document into a tree of sections, which only depends on the text
+# and the parsers. The parsed sections are kept in the cache, for the ones
+# which didn't change not to be parsed again.
+def parse_document(converter, pctxt, infile, source=None, stats=None, profile=None):
+    if stats is None:
+        stats = Stats()
+    start = time.time()
 
     hasSummary = False
 
     data = []
-    fd = file(infile,"r")
+    if source is None:
+        fd = file(infile,"r")
+    else:
+        fd = StringIO(source)
     for line in fd:
         line.replace("\t", " " * 8)
         line = line.rstrip()
         data.append(line)
     fd.close()
+    stats.count('lines', len(data))
+    start = stats.phase('read', start)
 
     parsers = init_parsers(pctxt)
-
+    cache = converter.get_cache()
+    if profile is not None:
+        parsers = [ProfiledParser(parser, stats, profile) for parser in parsers]
+    elif converter.stats:
+        parsers = [TimedParser(parser, stats) for parser in parsers]
+    dispatcher = Dispatcher(pctxt, parsers)
+
+    # The sections can be parsed in parallel once the headers are known, but
+    # not from a worker process, which can't start processes of its own
+    jobs = converter.section_jobs
+    if profile is not None or multiprocessing.current_process().daemon:
+        jobs = 1
+    pending = []
+
+    # The tree doesn't depend on the base of the links, which is only known
+    # when rendering
     pctxt.context = {
             'headers':  {},
             'document': "",
-            'base':     base,
     }
 
     sections = []
     currentSection = {
             "details": getTitleDetails(""),
-            "content": "",
+            "content": [],
+            "line": 1,
     }
 
     chapters = {}
@@ -296,18 +1681,19 @@ def convert(pctxt, infile, outfile, base=''):
             sections.append(currentSection)
             currentSection = {
                 "details": getTitleDetails(line),
-                "content": "",
+                "content": [],
             }
             j = 0
             i += 1 # Skip underline
             while not data[i + 1].rstrip():
                 i += 1 # Skip empty lines
+            currentSection["line"] = i + 2
 
         else:
             if len(line) > 80:
                 print >> sys.stderr, "Line `%i' exceeds 80 columns" % (i + 1)
 
-            currentSection["content"] = currentSection["content"] + line + "\n"
+            currentSection["content"].append(line)
             j += 1
             if currentSection["details"]["title"] == "Summary" and line != "":
                 hasSummary = True
@@ -319,8 +1705,8 @@ def convert(pctxt, infile, outfile, base=''):
     sections.append(currentSection)
 
     chapterIndexes = sorted(chapters.keys(), key=lambda chapter: map(int, chapter.split('.')))
-
-    document = ""
+    stats.count('sections', len(sections))
+    start = stats.phase('split', start)
 
     # Complete the summary
     for section in sections:
@@ -329,167 +1715,252 @@ def convert(pctxt, infile, outfile, base=''):
         if title:
             fulltitle = title
             if details["chapter"]:
-                #documentAppend("<a name=\"%s\"></a>" % details["chapter"])
+                #output.append("<a name=\"%s\"></a>" % details["chapter"])
                 fulltitle = details["chapter"] + ". " + title
                 if not details["chapter"] in chapters:
                     print >> sys.stderr, "Adding '%s' to the summary" % details["title"]
                     chapters[details["chapter"]] = details
                     chapterIndexes = sorted(chapters.keys())
 
+    # Sections are parsed one after the other into the document tree, or
+    # handed to a pool of processes with section_jobs. Each parsed section is
+    # made of HTML strings and of nodes, rendered later by the parser of their
+    # kind.
+    tree = {
+            'name': infile,
+            'header': False,
+            'chapters': chapters,
+            'chapterIndexes': chapterIndexes,
+            'keywords': keywords,
+            'sections': [],
+    }
     for section in sections:
         details = section["details"]
         pctxt.details = details
-        level = details["level"]
         title = details["title"]
-        content = section["content"].rstrip()
+        content = "\n".join(section["content"]).rstrip()
 
         print >> sys.stderr, "Parsing chapter %s..." % title
 
+        parsed = {
+                'details': details,
+                'summary': False,
+                'skip': False,
+                'digest': hashlib.sha1(content).hexdigest(),
+                'items': None,
+                'keywords': {},
+        }
+        tree['sections'].append(parsed)
+
         if (title == "Summary") or (title and not hasSummary):
-            summaryTemplate = pctxt.templates.get_template('summary.html')
-            documentAppend(summaryTemplate.render(
-                pctxt = pctxt,
-                chapters = chapters,
-                chapterIndexes = chapterIndexes,
-            ))
+            # The summary is rendered before this section
+            parsed['summary'] = True
             if title and not hasSummary:
                 hasSummary = True
             else:
+                parsed['skip'] = True
                 continue
 
-        if title:
-            documentAppend('<a class="anchor" id="%s" name="%s"></a>' % (details["chapter"], details["chapter"]))
-            if level == 1:
-                documentAppend("<div class=\"page-header\">", False)
-            documentAppend('<h%d id="chapter-%s" data-target="%s"><small><a class="small" href="#%s">%s.</a></small> %s</h%d>' % (level, details["chapter"], details["chapter"], details["chapter"], details["chapter"], cgi.escape(title, True), level))
-            if level == 1:
-                documentAppend("</div>", False)
+        key = None
+        if cache is not None and title:
+            key = cache.key(pctxt, details, parsed['digest'], False)
+            cached = cache.get(key)
+            if cached is not None:
+                parsed['items'], parsed['keywords'] = cached
+                mergeKeywords(keywords, parsed['keywords'])
+                stats.count('cached sections')
+                continue
+
+        if jobs > 1 and content and title:
+            pending.append((parsed, content, key))
+            continue
+
+        # Keywords defined in this section, kept along its tree in the cache
+        sectionKeywords = parsed['keywords']
+        pctxt.keywords = sectionKeywords
 
         if content:
-            if False and title:
-                # Display a navigation bar
-                documentAppend('<ul class="well pager">')
-                documentAppend('<li><a href="#top">Top</a></li>', False)
-                index = chapterIndexes.index(details["chapter"])
-                if index > 0:
-                    documentAppend('<li class="previous"><a href="#%s">Previous</a></li>' % chapterIndexes[index - 1], False)
-                if index < len(chapterIndexes) - 1:
-                    documentAppend('<li class="next"><a href="#%s">Next</a></li>' % chapterIndexes[index + 1], False)
-                documentAppend('</ul>', False)
-            content = cgi.escape(content, True)
-            content = re.sub(r'section ([0-9]+(.[0-9]+)*)', r'<a href="#\1">section \1</a>', content)
-
-            pctxt.set_content(content)
+            if profile is not None:
+                profile.begin_section(chapters, details, section["line"])
+            pctxt.set_content(escape_section(content))
 
             if not title:
-                lines = pctxt.get_lines()
-                pctxt.context['headers'] = {
-                    'title':    '',
-                    'subtitle': '',
-                    'version':  '',
-                    'author':   '',
-                    'date':     ''
-                }
-                if re.match("^-+$", pctxt.get_line().strip()):
-                    # Try to analyze the header of the file, assuming it follows
-                    # those rules :
-                    # - it begins with a "separator line" (several '-' chars)
-                    # - then the document title
-                    # - an optional subtitle
-                    # - a new separator line
-                    # - the version
-                    # - the author
-                    # - the date
-                    pctxt.next()
-                    pctxt.context['headers']['title'] = pctxt.get_line().strip()
-                    pctxt.next()
-                    subtitle = ""
-                    while not re.match("^-+$", pctxt.get_line().strip()):
-                        subtitle += " " + pctxt.get_line().strip()
-                        pctxt.next()
-                    pctxt.context['headers']['subtitle'] += subtitle.strip()
-                    if not pctxt.context['headers']['subtitle']:
-                        # No subtitle, try to guess one from the title if it
-                        # starts with the word "HAProxy"
-                        if pctxt.context['headers']['title'].startswith('HAProxy '):
-                            pctxt.context['headers']['subtitle'] = pctxt.context['headers']['title'][8:]
-                            pctxt.context['headers']['title'] = 'HAProxy'
-                    pctxt.next()
-                    pctxt.context['headers']['version'] = pctxt.get_line().strip()
-                    pctxt.next()
-                    pctxt.context['headers']['author'] = pctxt.get_line().strip()
-                    pctxt.next()
-                    pctxt.context['headers']['date'] = pctxt.get_line().strip()
-                    pctxt.next()
-                    if HAPROXY_GIT_VERSION:
-                        pctxt.context['headers']['version'] = 'version ' + HAPROXY_GIT_VERSION
-
-                    # Skip header lines
-                    pctxt.eat_lines()
-                    pctxt.eat_empty_lines()
-
-            documentAppend('<div>', False)
+                # The version can be replaced when rendering
+                tree['header'] = parse_headers(pctxt)
+
+            try:
+                specialSection = specialSections[details["chapter"]]
+            except:
+                specialSection = specialSections["default"]
+
+            parsed['items'] = parse_lines(pctxt, dispatcher)
+
+        mergeKeywords(keywords, sectionKeywords)
+        if key:
+            cache.put(key, (parsed['items'], sectionKeywords))
+
+    if pending:
+        batches = split_sections(pending, jobs)
+        pool = multiprocessing.Pool(min(jobs, len(batches)))
+        try:
+            results = pool.map(parse_sections_job, [
+                (converter, chapters, pctxt.context['headers'], [(parsed['details'], content) for parsed, content, key in batch])
+                for batch in batches
+            ])
+        finally:
+            pool.close()
+            pool.join()
+        for batch, (batchResults, batchStats) in zip(batches, results):
+            stats.merge(batchStats)
+            for (parsed, content, key), (items, sectionKeywords) in zip(batch, batchResults):
+                parsed['items'] = items
+                parsed['keywords'] = sectionKeywords
+                mergeKeywords(keywords, sectionKeywords)
+                if key:
+                    cache.put(key, (items, sectionKeywords))
+    pctxt.keywords = keywords
 
-            delay = []
-            while pctxt.has_more_lines():
-                try:
-                    specialSection = specialSections[details["chapter"]]
-                except:
-                    specialSection = specialSections["default"]
+    tree['headers'] = pctxt.context['headers']
+    # No section was preceded by the summary
+    tree['summary'] = not hasSummary
+    start = stats.phase('parse', start)
+    return tree
 
-                line = pctxt.get_line()
-                if i < nblines - 1:
-                    nextline = pctxt.get_line(1)
-                else:
-                    nextline = ""
-
-                oldline = line
-                pctxt.stop = False
-                for parser in parsers:
-                    line = parser.parse(line)
-                    if pctxt.stop:
-                        break
-                if oldline == line:
-                    # nothing has changed,
-                    # delays the rendering
-                    if delay or line != "":
-                        delay.append(line)
-                    pctxt.next()
-                elif pctxt.stop:
-                    while delay and delay[-1].strip() == "":
-                        del delay[-1]
-                    if delay:
-                        remove_indent(delay)
-                        documentAppend('<pre class="text">%s\n</pre>' % "\n".join(delay), False)
-                    delay = []
-                    documentAppend(line, False)
-                else:
-                    while delay and delay[-1].strip() == "":
-                        del delay[-1]
-                    if delay:
-                        remove_indent(delay)
-                        documentAppend('<pre class="text">%s\n</pre>' % "\n".join(delay), False)
-                    delay = []
-                    documentAppend(line, True)
-                    pctxt.next()
+# Render the nodes of the document tree, by kind
+def init_renderers(pctxt):
+    renderers = {
+        'text': lambda lines: '<pre class="text">%s\n</pre>' % "\n".join(lines),
+    }
+    for parser in init_parsers(pctxt):
+        renderers[parser.__module__.split('.')[-1]] = parser.render
+    return renderers
+
+# Keywords of the sidebar as a JSON array, searched by the page instead of the
+# list itself. Each entry is the keyword, or [keyword, anchor] when it leads to
+# another anchor.
+def get_keywords_index(keywords, aliases):
+    index = []
+    for keyword in keywords:
+        if keyword in aliases:
+            index.append([keyword, aliases[keyword]])
+        else:
+            index.append(keyword)
+    # Safe to be written in a script element
+    return json.dumps(index, separators=(',', ':')).replace('</', '<\\/')
+
+# With compact anchors, only the anchor a keyword links to is written in the
+# page. Return the other names of anchors, mapped to the anchor of the keyword
+# they lead to : as in browsers, the first keyword having a name wins.
+def get_anchor_aliases(pctxt, tree):
+    keywordParser = keyword.Parser(pctxt)
+    aliases = {}
+    names = set()
+    for section in tree['sections']:
+        for item in section['items'] or []:
+            if not isinstance(item, Node) or item.kind != 'keyword':
+                continue
+            anchor, keywordNames = keywordParser.get_anchors(**item.fields)
+            for name in keywordNames:
+                if name in names:
+                    continue
+                names.add(name)
+                if name != anchor:
+                    aliases[name] = anchor
+    return aliases
+
+# Render a document tree and link its keywords. The rendered sections are
+# kept in the cache, for the ones which didn't change to be reused as is.
+def render_document(converter, pctxt, tree, output=None, stats=None):
+    if stats is None:
+        stats = Stats()
+    start = time.time()
+
+    base = converter.base
+    if len(base) > 0 and base[:-1] != '/':
+        base += '/'
 
-            while delay and delay[-1].strip() == "":
-                del delay[-1]
-            if delay:
-                remove_indent(delay)
-                documentAppend('<pre class="text">%s\n</pre>' % "\n".join(delay), False)
-            delay = []
-            documentAppend('</div>')
+    headers = dict(tree['headers'])
+    if tree['header'] and converter.haproxy_version:
+        headers['version'] = 'version ' + converter.haproxy_version
+
+    chapters = tree['chapters']
+    chapterIndexes = tree['chapterIndexes']
+
+    pctxt.context = {
+            'headers':  headers,
+            'document': "",
+            'base':     base,
+            'compactAnchors': converter.compact_anchors,
+    }
+    pctxt.keywords = tree['keywords']
+    pctxt.keywordsCount = {}
+    pctxt.chapters = chapters
+
+    cache = converter.get_cache()
+    renderers = init_renderers(pctxt)
+
+    if output is None:
+        output = DocumentBuilder()
+
+    # Only the current section is kept in memory when the output is spooled
+    for section in tree['sections']:
+        output.flush()
+        details = section['details']
+        pctxt.details = details
+        level = details["level"]
+        title = details["title"]
 
-    if not hasSummary:
-        summaryTemplate = pctxt.templates.get_template('summary.html')
-        print chapters
-        document = summaryTemplate.render(
+        if section['summary']:
+            summaryTemplate = pctxt.get_template('summary.html')
+            output.append(summaryTemplate.render(
+                pctxt = pctxt,
+                chapters = chapters,
+                chapterIndexes = chapterIndexes,
+            ))
+        if section['skip']:
+            continue
+        output.flush()
+
+        key = None
+        if cache is not None and title:
+            key = cache.key(pctxt, details, section['digest'])
+            fragment = cache.get(key)
+            if fragment is not None:
+                output.append(fragment, False)
+                stats.count('cached fragments')
+                continue
+
+        if title:
+            output.append('<a class="anchor" id="%s" name="%s"></a>' % (details["chapter"], details["chapter"]))
+            if level == 1:
+                output.append("<div class=\"page-header\">", False)
+            output.append('<h%d id="chapter-%s" data-target="%s"><small><a class="small" href="#%s">%s.</a></small> %s</h%d>' % (level, details["chapter"], details["chapter"], details["chapter"], details["chapter"], cgi.escape(title, True), level))
+            if level == 1:
+                output.append("</div>", False)
+
+        if section['items'] is not None:
+            output.append('<div>', False)
+            for item in section['items']:
+                if isinstance(item, Node):
+                    item = renderers[item.kind](**item.fields)
+                output.append(item, False)
+            output.append('</div>')
+
+        fragment = output.flush()
+        if key:
+            cache.put(key, fragment)
+
+    if tree['summary']:
+        summaryTemplate = pctxt.get_template('summary.html')
+        output.prepend(summaryTemplate.render(
             pctxt = pctxt,
             chapters = chapters,
             chapterIndexes = chapterIndexes,
-        ) + document
+        ))
+    start = stats.phase('render', start)
 
+    keywords = tree['keywords']
+    keywordsCount = pctxt.keywordsCount
 
     # Log warnings for keywords defined in several chapters
     keyword_conflicts = {}
@@ -502,49 +1973,78 @@ def convert(pctxt, infile, outfile, base=''):
 
     keywords = list(keywords)
     keywords.sort()
+    stats.count('keywords', len(keywords))
 
-    createLinks()
-
-    # Add the keywords conflicts to the keywords list to make them available in the search form
-    # And remove the original keyword which is now useless
-    for keyword in keyword_conflicts:
-        sections = keyword_conflicts[keyword]
-        offset = keywords.index(keyword)
-        for section in sections:
-            keywords.insert(offset, "%s (%s)" % (keyword, chapters[section]['title']))
-            offset += 1
-        keywords.remove(keyword)
+    aliases = {}
+    if converter.compact_anchors:
+        aliases = get_anchor_aliases(pctxt, tree)
+        stats.count('anchor aliases', len(aliases))
 
+    # The linked document is removed if the conversion fails after it was
+    # spooled, as the caller never gets it
+    document_file = None
     try:
-        footerTemplate = pctxt.templates.get_template('footer.html')
-        footer = footerTemplate.render(
-            pctxt = pctxt,
-            headers = pctxt.context['headers'],
-            document = document,
-            chapters = chapters,
-            chapterIndexes = chapterIndexes,
-            keywords = keywords,
-            keywordsCount = keywordsCount,
-            keyword_conflicts = keyword_conflicts,
-            version = VERSION,
-            date = datetime.datetime.now().strftime("%Y/%m/%d"),
-        )
-    except TopLevelLookupException:
-        footer = ""
+        # Now that all the keywords are known, link them section by section
+        if output.spool is None:
+            document = "".join(createLinks(output.get_fragments(), keywords, keywordsCount, keyword_conflicts, chapters, aliases))
+        else:
+            document = None
+            fd, document_file = tempfile.mkstemp(prefix='haproxy-dconv-', suffix='.html')
+            with os.fdopen(fd, 'wb') as linked:
+                for fragment in createLinks(output.get_fragments(), keywords, keywordsCount, keyword_conflicts, chapters, aliases):
+                    linked.write(encode(fragment))
+        stats.count('conflicts', len(keyword_conflicts))
+        start = stats.phase('link', start)
+
+        # Add the keywords conflicts to the keywords list to make them available in the search form
+        # And remove the original keyword which is now useless
+        for keyword in keyword_conflicts:
+            sections = keyword_conflicts[keyword]
+            offset = keywords.index(keyword)
+            for section in sections:
+                keywords.insert(offset, "%s (%s)" % (keyword, chapters[section]['title']))
+                offset += 1
+            keywords.remove(keyword)
+
+        try:
+            footerTemplate = pctxt.get_template('footer.html')
+            footer = footerTemplate.render(
+                pctxt = pctxt,
+                headers = pctxt.context['headers'],
+                document = document,
+                chapters = chapters,
+                chapterIndexes = chapterIndexes,
+                keywords = keywords,
+                keywordsCount = keywordsCount,
+                keyword_conflicts = keyword_conflicts,
+                version = converter.version,
+                date = datetime.datetime.now().strftime("%Y/%m/%d"),
+            )
+        except TopLevelLookupException:
+            footer = ""
+    except:
+        if document_file:
+            os.remove(document_file)
+        raise
 
     return {
             'pctxt': pctxt,
             'headers': pctxt.context['headers'],
             'base': base,
             'document': document,
+            'document_file': document_file,
             'chapters': chapters,
             'chapterIndexes': chapterIndexes,
             'keywords': keywords,
             'keywordsCount': keywordsCount,
             'keyword_conflicts': keyword_conflicts,
-            'version': VERSION,
+            'aliases': aliases,
+            'keywordsIndex': get_keywords_index(keywords, aliases),
+            'lazyKeywords': converter.lazy_keywords,
+            'version': converter.version,
             'date': datetime.datetime.now().strftime("%Y/%m/%d"),
-            'footer': footer
+            'footer': footer,
+            'stats': stats,
     }
 
 if __name__ == '__main__':
@@ -1,3 +1,6 @@
+import re
+import array
+
 __all__ = [
     'arguments',
     'example',
@@ -9,16 +12,124 @@ __all__ = [
 
 
 class Parser:
+    # Regexes that the current line or the next one must contain for the
+    # parser to apply, searched in multiline mode and never matching across
+    # lines. A parser without any of them is called on every line.
+    linePattern = None
+    nextLinePattern = None
+
     def __init__(self, pctxt):
         self.pctxt = pctxt
 
     def parse(self, line):
         return line
 
+    # Turn the fields of a node returned by parse() into HTML
+    def render(self, **fields):
+        return ""
+
+
+# Part of a parsed document, rendered later by the parser of the same kind
+# (the name of its module), so that the parsed document can be rendered again
+# with other templates or another base.
+class Node:
+    def __init__(self, kind, **fields):
+        self.kind = kind
+        self.fields = fields
+
+
+# Select the parsers that can apply to the current line, in their original
+# order. Lines are classified once per content : each pattern is searched in
+# the whole content, so that lines without any match cost nothing.
+class Dispatcher:
+    def __init__(self, pctxt, parsers):
+        self.pctxt = pctxt
+        self.parsers = parsers
+        self.always = []
+        self.patterns = []
+        for index, parser in enumerate(parsers):
+            if parser.linePattern is None and parser.nextLinePattern is None:
+                self.always.append(index)
+            if parser.linePattern is not None:
+                self.patterns.append((index, 0, re.compile(parser.linePattern, re.M)))
+            if parser.nextLinePattern is not None:
+                self.patterns.append((index, -1, re.compile(parser.nextLinePattern, re.M)))
+        self.defaults = [parsers[index] for index in self.always]
+        self.lines = None
+        self.selections = {}
+
+    def classify(self):
+        lines = self.pctxt.lines
+        content = "\n".join(lines)
+
+        selected = {}
+        for index, shift, pattern in self.patterns:
+            # Matches come in order, count the lines between each of them
+            lineno = shift
+            pos = 0
+            for match in pattern.finditer(content):
+                start = match.start()
+                lineno += content.count("\n", pos, start)
+                pos = start
+                selected.setdefault(lineno, []).append(index)
+
+        self.selections = {}
+        for lineno, indexes in selected.iteritems():
+            self.selections[lineno] = [self.parsers[index] for index in sorted(set(indexes + self.always))]
+        self.lines = lines
+
+    def get_parsers(self):
+        if self.pctxt.lines is not self.lines:
+            self.classify()
+        return self.selections.get(self.pctxt.i, self.defaults)
+
+
+# Render a template made only of plain text and ${name} expressions without
+# going through Mako
+class SimpleTemplate:
+    expressionPattern = re.compile(r'\$\{\s*([A-Za-z_][A-Za-z0-9_]*)\s*\}')
+    # Mako syntax that can't be handled by a simple substitution
+    complexPattern = re.compile(r'<%|</%|^\s*%|\\$|##|\$\{', re.M)
+
+    def __init__(self, format):
+        self.format = format
+
+    def render(self, **data):
+        return self.format % data
+
+    @classmethod
+    def compile(cls, source):
+        format = source.replace('%', '%%')
+        format = cls.expressionPattern.sub(r'%(\1)s', format)
+        if cls.complexPattern.search(cls.expressionPattern.sub('', source)):
+            return None
+        return cls(format)
+
 class PContext:
     def __init__(self, templates = None):
         self.set_content_list([])
         self.templates = templates
+        self.loaded_templates = {}
+
+    # Templates are resolved once per context
+    def get_template(self, name):
+        try:
+            return self.loaded_templates[name]
+        except KeyError:
+            template = self.templates.get_template(name)
+            self.loaded_templates[name] = template
+            return template
+
+    # Same as get_template(), with a fast path for the simplest templates
+    def get_simple_template(self, name):
+        key = ('simple', name)
+        try:
+            return self.loaded_templates[key]
+        except KeyError:
+            template = self.get_template(name)
+            template = SimpleTemplate.compile(template.source) or template
+            self.loaded_templates[key] = template
+            return template
 
     def set_content(self, content):
         self.set_content_list(content.split("\n"))
@@ -29,19 +140,25 @@ class PContext:
         self.i = 0
         self.stop = False
 
+        # Facts about each line, computed once for all the parsers
+        self.stripped = [line.rstrip() for line in content]
+        self.indents = array.array('H', [get_indent(line) for line in self.stripped])
+        self.empty = bytearray([not line for line in self.stripped])
+        self.dashes = bytearray([line != '' and not line.strip('-') for line in self.stripped])
+
     def get_lines(self):
         return self.lines
 
     def eat_lines(self):
         count = 0
-        while self.has_more_lines() and self.lines[self.i].strip():
+        while self.has_more_lines() and not self.empty[self.i]:
             count += 1
             self.next()
         return count
 
     def eat_empty_lines(self):
         count = 0
-        while self.has_more_lines() and not self.lines[self.i].strip():
+        while self.has_more_lines() and self.empty[self.i]:
             count += 1
             self.next()
         return count
@@ -53,16 +170,22 @@ class PContext:
         return self.i + offset < self.nblines
 
     def get_line(self, offset=0):
-        return self.lines[self.i + offset].rstrip()
+        return self.stripped[self.i + offset]
+
+    def get_indent(self, offset=0):
+        return self.indents[self.i + offset]
+
+    def is_empty(self, offset=0):
+        return self.empty[self.i + offset]
+
+    # The line is only made of '-' characters
+    def is_dashes(self, offset=0):
+        return self.dashes[self.i + offset]
 
 
 # Get the indentation of a line
 def get_indent(line):
-        indent = 0
-        length = len(line)
-        while indent < length and line[indent] == ' ':
-            indent += 1
-        return indent
+        return len(line) - len(line.lstrip(' '))
 
 
 # Remove unneeded indentation
@@ -6,10 +6,13 @@ import parser
 TODO: Allow inner data parsing (this will allow to parse the examples provided in an arguments block)
 '''
 class Parser(parser.Parser):
+    linePattern = r'Arguments? *:'
+
     def __init__(self, pctxt):
         parser.Parser.__init__(self, pctxt)
         #template = pctxt.templates.get_template("parser/arguments.tpl")
         #self.replace = template.render().strip()
+        self.template = pctxt.get_template("parser/arguments.tpl")
 
     def parse(self, line):
         #return re.sub(r'(Arguments *:)', self.replace, line)
@@ -23,7 +26,7 @@ class Parser(parser.Parser):
             desc_indent = False
             desc = re.sub(r'.*Arguments? *:', '', line).strip()
 
-            indent = parser.get_indent(line)
+            indent = pctxt.get_indent()
 
             pctxt.next()
             pctxt.eat_empty_lines()
@@ -31,7 +34,7 @@ class Parser(parser.Parser):
             arglines = []
             if desc != "none":
                 add_empty_lines = 0
-                while pctxt.has_more_lines() and (parser.get_indent(pctxt.get_line()) > indent):
+                while pctxt.has_more_lines() and (pctxt.get_indent() > indent):
                     for j in xrange(0, add_empty_lines):
                         arglines.append("")
                     arglines.append(pctxt.get_line())
@@ -78,18 +81,18 @@ class Parser(parser.Parser):
 
             pctxt.stop = True
 
-            template = pctxt.templates.get_template("parser/arguments.tpl")
-            return template.render(
-                pctxt=pctxt,
-                label=label,
-                desc=desc,
-                content=arglines
-                #content=content
-            )
-            return line
+            return parser.Node('arguments', label=label, desc=desc, content=arglines)
 
         return line
 
+    def render(self, label, desc, content):
+        return self.template.render(
+            pctxt=self.pctxt,
+            label=label,
+            desc=desc,
+            content=content
+        )
+
 '''
     def parse_args(self, data):
         args = []
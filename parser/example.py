@@ -3,10 +3,13 @@ import parser
 
 # Detect examples blocks
 class Parser(parser.Parser):
+    linePattern = r'^ *Examples? *:'
+
     def __init__(self, pctxt):
         parser.Parser.__init__(self, pctxt)
-        template = pctxt.templates.get_template("parser/example/comment.tpl")
+        template = pctxt.get_template("parser/example/comment.tpl")
         self.comment = template.render(pctxt=pctxt).strip()
+        self.template = pctxt.get_template("parser/example.tpl")
 
 
     def parse(self, line):
@@ -23,11 +26,11 @@ class Parser(parser.Parser):
             if desc:
                 desc_indent = len(line) - len(desc)
 
-            indent = parser.get_indent(line)
+            indent = pctxt.get_indent()
 
             if desc:
                 # And some description are on multiple lines
-                while pctxt.get_line(1) and parser.get_indent(pctxt.get_line(1)) == desc_indent:
+                while not pctxt.is_empty(1) and pctxt.get_indent(1) == desc_indent:
                     desc += " " + pctxt.get_line(1).strip()
                     pctxt.next()
 
@@ -35,22 +38,25 @@ class Parser(parser.Parser):
             add_empty_line = pctxt.eat_empty_lines()
 
             content = []
+            # Comments are highlighted in the examples having their own block
+            comments = False
 
-            if parser.get_indent(pctxt.get_line()) > indent:
+            if pctxt.get_indent() > indent:
+                comments = True
                 if desc:
                     desc = desc[0].upper() + desc[1:]
                 add_empty_line = 0
-                while pctxt.has_more_lines() and ((not pctxt.get_line()) or (parser.get_indent(pctxt.get_line()) > indent)):
-                    if pctxt.get_line():
+                while pctxt.has_more_lines() and (pctxt.is_empty() or (pctxt.get_indent() > indent)):
+                    if not pctxt.is_empty():
                         for j in xrange(0, add_empty_line):
                             content.append("")
 
-                        content.append(re.sub(r'(#.*)$', self.comment, pctxt.get_line()))
+                        content.append(pctxt.get_line())
                         add_empty_line = 0
                     else:
                         add_empty_line += 1
                     pctxt.next()
-            elif parser.get_indent(pctxt.get_line()) == indent:
+            elif pctxt.get_indent() == indent:
                 # Simple example that can't have empty lines
                 if add_empty_line and desc:
                     # This means that the example was on the same line as the 'Example' tag
@@ -58,7 +64,7 @@ class Parser(parser.Parser):
                     content.append(" " * indent + desc)
                     desc = False
                 else:
-                    while pctxt.has_more_lines() and (parser.get_indent(pctxt.get_line()) >= indent):
+                    while pctxt.has_more_lines() and (pctxt.get_indent() >= indent):
                         content.append(pctxt.get_line())
                         pctxt.next()
                     pctxt.eat_empty_lines() # Skip empty remaining lines
@@ -67,11 +73,15 @@ class Parser(parser.Parser):
 
             parser.remove_indent(content)
 
-            template = pctxt.templates.get_template("parser/example.tpl")
-            return template.render(
-                pctxt=pctxt,
-                label=label,
-                desc=desc,
-                content=content
-            )
+            return parser.Node('example', label=label, desc=desc, content=content, comments=comments)
         return line
+
+    def render(self, label, desc, content, comments):
+        if comments:
+            content = [re.sub(r'(#.*)$', self.comment, line) for line in content]
+        return self.template.render(
+            pctxt=self.pctxt,
+            label=label,
+            desc=desc,
+            content=content
+        )
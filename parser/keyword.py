@@ -3,6 +3,9 @@ import parser
 from urllib import quote
 
 class Parser(parser.Parser):
+    # Keywords and comments start at the beginning of the line
+    linePattern = r'^[^ \n]'
+
     def __init__(self, pctxt):
         parser.Parser.__init__(self, pctxt)
         self.keywordPattern = re.compile(r'^(%s%s)(%s)' % (
@@ -40,41 +43,39 @@ class Parser(parser.Parser):
 
             if keyword and (len(splitKeyword) <= 5):
                 toplevel = pctxt.details["toplevel"]
+                chapter = pctxt.details["chapter"]
+                subKeywords = []
                 for j in xrange(0, len(splitKeyword)):
                     subKeyword = " ".join(splitKeyword[0:j + 1])
                     if subKeyword != "no":
                         if not subKeyword in keywords:
                             keywords[subKeyword] = set()
-                        keywords[subKeyword].add(pctxt.details["chapter"])
-                    res += '<a class="anchor" name="%s"></a>' % subKeyword
-                    res += '<a class="anchor" name="%s-%s"></a>' % (toplevel, subKeyword)
-                    res += '<a class="anchor" name="%s-%s"></a>' % (pctxt.details["chapter"], subKeyword)
-                    res += '<a class="anchor" name="%s (%s)"></a>' % (subKeyword, chapters[toplevel]['title'])
-                    res += '<a class="anchor" name="%s (%s)"></a>' % (subKeyword, chapters[pctxt.details["chapter"]]['title'])
-
-                deprecated = parameters.find("(deprecated)")
-                if deprecated != -1:
-                    prefix = ""
-                    suffix = ""
-                    parameters = parameters.replace("(deprecated)", '<span class="label label-warning">(deprecated)</span>')
-                else:
-                    prefix = ""
-                    suffix = ""
+                        keywords[subKeyword].add(chapter)
+                    subKeywords.append(subKeyword)
 
                 nextline = pctxt.get_line(1)
 
+                # Only the parameters on the keyword line can be deprecated
+                continuation = ""
                 while nextline.startswith("   "):
                     # Found parameters on the next line
-                    parameters += "\n" + nextline
+                    continuation += "\n" + nextline
                     pctxt.next()
                     if pctxt.has_more_lines(1):
                         nextline = pctxt.get_line(1)
                     else:
                         nextline = ""
 
-
-                parameters = self.colorize(parameters)
-                res += '<div class="keyword">%s<b><a class="anchor" name="%s"></a><a href="#%s">%s</a></b>%s%s</div>' % (prefix, keyword, quote("%s-%s" % (pctxt.details["chapter"], keyword)), keyword, parameters, suffix)
+                res = parser.Node('keyword',
+                    keyword=keyword,
+                    subKeywords=subKeywords,
+                    parameters=parameters,
+                    continuation=continuation,
+                    chapter=chapter,
+                    toplevel=toplevel,
+                    chapterTitle=chapters[chapter]['title'],
+                    toplevelTitle=chapters[toplevel]['title'],
+                )
                 pctxt.next()
                 pctxt.stop = True
             elif line.startswith("/*"):
@@ -90,53 +91,78 @@ class Parser(parser.Parser):
 
         return res
 
-    # Used to colorize keywords parameters
-    # TODO : use CSS styling
+    def render(self, keyword, subKeywords, parameters, continuation, chapter, toplevel, chapterTitle, toplevelTitle):
+        anchor, names = self.get_anchors(keyword, subKeywords, chapter, toplevel, chapterTitle, toplevelTitle)
+        res = ""
+        if self.pctxt.context.get('compactAnchors'):
+            # The other names are resolved by the page, from its aliases
+            res += '<a class="anchor" name="%s"></a>' % anchor
+            keywordAnchor = ""
+        else:
+            for name in names[:-1]:
+                res += '<a class="anchor" name="%s"></a>' % name
+            keywordAnchor = '<a class="anchor" name="%s"></a>' % keyword
+
+        parameters = parameters.replace("(deprecated)", '<span class="label label-warning">(deprecated)</span>')
+        parameters = self.colorize(parameters + continuation)
+        res += '<div class="keyword"><b>%s<a href="#%s">%s</a></b>%s</div>' % (keywordAnchor, quote(anchor), keyword, parameters)
+        return res
+
+    # Return the anchor a keyword links to, and all the names of anchors
+    # leading to the keyword, in the order of the page
+    def get_anchors(self, keyword, subKeywords, chapter, toplevel, chapterTitle, toplevelTitle, **fields):
+        names = []
+        for subKeyword in subKeywords:
+            names.append(subKeyword)
+            names.append("%s-%s" % (toplevel, subKeyword))
+            names.append("%s-%s" % (chapter, subKeyword))
+            names.append("%s (%s)" % (subKeyword, toplevelTitle))
+            names.append("%s (%s)" % (subKeyword, chapterTitle))
+        names.append(keyword)
+        return ("%s-%s" % (chapter, keyword), names)
+
+    # Used to colorize keywords parameters : each opening tag starts a span,
+    # closed by the matching tag, unterminated inner tags being closed first
+    openingTags = {
+            "[":    "keyword-optional",
+            "{":    "keyword-choice",
+            "&lt;": "keyword-argument",
+    }
+    closingTags = {
+            "]":    "[",
+            "}":    "{",
+            "&gt;": "&lt;",
+    }
+    tagPattern = re.compile(r'\[|\]|\{|\}|&lt;|&gt;')
+
     def colorize(self, text):
-        colorized = ""
-        tags = [
-                [ "["   , "]"   , "#008" ],
-                [ "{"   , "}"   , "#800" ],
-                [ "&lt;", "&gt;", "#080" ],
-        ]
+        colorized = []
         heap = []
         pos = 0
-        while pos < len(text):
-            substring = text[pos:]
-            found = False
-            for tag in tags:
-                if substring.startswith(tag[0]):
-                    # Opening tag
-                    heap.append(tag)
-                    colorized += '<span style="color: %s">%s' % (tag[2], substring[0:len(tag[0])])
-                    pos += len(tag[0])
-                    found = True
-                    break
-                elif substring.startswith(tag[1]):
-                    # Closing tag
-
-                    # pop opening tags until the corresponding one is found
-                    openingTag = False
-                    while heap and openingTag != tag:
-                        openingTag = heap.pop()
-                        if openingTag != tag:
-                            colorized += '</span>'
-                    # all intermediate tags are now closed, we can display the tag
-                    colorized += substring[0:len(tag[1])]
-                    # and the close it if it was previously opened
-                    if openingTag == tag:
-                        colorized += '</span>'
-                    pos += len(tag[1])
-                    found = True
-                    break
-            if not found:
-                colorized += substring[0]
-                pos += 1
+        for match in self.tagPattern.finditer(text):
+            tag = match.group(0)
+            colorized.append(text[pos:match.start()])
+            pos = match.end()
+            if tag in self.openingTags:
+                heap.append(tag)
+                colorized.append('<span class="%s">%s' % (self.openingTags[tag], tag))
+            else:
+                # pop opening tags until the corresponding one is found
+                opening = self.closingTags[tag]
+                openingTag = False
+                while heap and openingTag != opening:
+                    openingTag = heap.pop()
+                    if openingTag != opening:
+                        colorized.append('</span>')
+                # all intermediate tags are now closed, we can display the tag
+                colorized.append(tag)
+                # and the close it if it was previously opened
+                if openingTag == opening:
+                    colorized.append('</span>')
+        colorized.append(text[pos:])
         # close all unterminated tags
-        while heap:
-            tag = heap.pop()
-            colorized += '</span>'
+        colorized.append('</span>' * len(heap))
 
-        return colorized
+        return "".join(colorized)
 
 
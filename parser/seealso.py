@@ -2,6 +2,12 @@ import re
 import parser
 
 class Parser(parser.Parser):
+    linePattern = r'See also *:'
+
+    def __init__(self, pctxt):
+        parser.Parser.__init__(self, pctxt)
+        self.template = pctxt.get_simple_template("parser/seealso.tpl")
+
     def parse(self, line):
         pctxt = self.pctxt
 
@@ -11,10 +17,10 @@ class Parser(parser.Parser):
 
             desc = re.sub(r'.*See also *:', '', line).strip()
 
-            indent = parser.get_indent(line)
+            indent = pctxt.get_indent()
 
             # Some descriptions are on multiple lines
-            while pctxt.has_more_lines(1) and parser.get_indent(pctxt.get_line(1)) >= indent and pctxt.get_line(1).strip() != '':
+            while pctxt.has_more_lines(1) and pctxt.get_indent(1) >= indent and not pctxt.is_empty(1):
                 desc += " " + pctxt.get_line(1).strip()
                 pctxt.next()
 
@@ -22,11 +28,13 @@ class Parser(parser.Parser):
             pctxt.next()
             pctxt.stop = True
 
-            template = pctxt.templates.get_template("parser/seealso.tpl")
-            return template.render(
-                pctxt=pctxt,
-                label=label,
-                desc=desc,
-            )
+            return parser.Node('seealso', label=label, desc=desc)
 
         return line
+
+    def render(self, label, desc):
+        return self.template.render(
+            pctxt=self.pctxt,
+            label=label,
+            desc=desc,
+        )
@@ -3,14 +3,18 @@ import sys
 import parser
 
 class Parser(parser.Parser):
+    linePattern = r'May be used in sections'
+    nextLinePattern = r'^ *(-+\+)+-+'
+
     def __init__(self, pctxt):
         parser.Parser.__init__(self, pctxt)
         self.table1Pattern = re.compile(r'^ *(-+\+)+-+')
         self.table2Pattern = re.compile(r'^ *\+(-+\+)+')
+        self.template = pctxt.get_template("parser/table.tpl")
+        self.headerTemplate = pctxt.get_template("parser/table/header.tpl")
+        self.rowTemplate = pctxt.get_template("parser/table/row.tpl")
 
     def parse(self, line):
-        global document, keywords, keywordsCount, chapters, keyword_conflicts
-
         pctxt = self.pctxt
 
         if pctxt.context['headers']['subtitle'] != 'Configuration Manual':
@@ -126,7 +130,7 @@ class Parser(parser.Parser):
             pctxt.next() # skip useless next line
             pctxt.stop = True
 
-            return self.renderTable(table, nbColumns, pctxt.details["toplevel"])
+            return parser.Node('table', table=table, maxColumns=nbColumns, toplevel=pctxt.details["toplevel"])
         # elif self.table2Pattern.match(line):
         #    return self.parse_table_format2()
         elif line.find("May be used in sections") != -1:
@@ -142,7 +146,7 @@ class Parser(parser.Parser):
             pctxt.next(2)  # skip this previous table
             pctxt.stop = True
 
-            return self.renderTable(table)
+            return parser.Node('table', table=table)
 
         return line
 
@@ -165,12 +169,12 @@ class Parser(parser.Parser):
                 pctxt.next()
         pctxt.stop = True
 
-        return self.renderTable(rows, maxcols)
+        return parser.Node('table', table=rows, maxColumns=maxcols)
 
     # Render tables detected by the conversion parser
-    def renderTable(self, table, maxColumns = 0, toplevel = None):
+    def render(self, table, maxColumns = 0, toplevel = None):
         pctxt  = self.pctxt
-        template = pctxt.templates.get_template("parser/table.tpl")
+        template = self.template
 
         res = ""
 
@@ -192,9 +196,9 @@ class Parser(parser.Parser):
             line = ""
 
             if i == 0:
-                row_template = pctxt.templates.get_template("parser/table/header.tpl")
+                row_template = self.headerTemplate
             else:
-                row_template = pctxt.templates.get_template("parser/table/row.tpl")
+                row_template = self.rowTemplate
 
             if i > 1 and (i  - 1) % 20 == 0 and len(table) > 50:
                 # Repeat headers periodically for long tables
@@ -1,16 +1,23 @@
 import parser
 
 class Parser(parser.Parser):
+    nextLinePattern = r'^-'
+
+    def __init__(self, pctxt):
+        parser.Parser.__init__(self, pctxt)
+        self.template = pctxt.get_simple_template("parser/underline.tpl")
+
     # Detect underlines
     def parse(self, line):
         pctxt = self.pctxt
         if pctxt.has_more_lines(1):
-            nextline = pctxt.get_line(1)
-            if (len(line) > 0) and (len(nextline) > 0) and (nextline[0] == '-') and ("-" * len(line) == nextline):
-                template = pctxt.templates.get_template("parser/underline.tpl")
-                line = template.render(pctxt=pctxt, data=line).strip()
+            if (len(line) > 0) and pctxt.is_dashes(1) and (len(pctxt.get_line(1)) == len(line)):
+                line = parser.Node('underline', data=line)
                 pctxt.next(2)
                 pctxt.eat_empty_lines()
                 pctxt.stop = True
 
         return line
+
+    def render(self, data):
+        return self.template.render(pctxt=self.pctxt, data=data).strip()
@@ -0,0 +1,487 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2012 Cyril Bonté
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Measure the converter on manuals of several sizes.
+#
+# Synthetic manuals shaped like configuration.txt (summary, chapters,
+# keywords with their arguments, examples, "See also" lines, keywords
+# matrices and tables) are generated for each scale, then converted, linked
+# and exported. Existing manuals can be measured too, by giving their paths.
+#
+# Each conversion runs in its own process, for its peak memory to be
+# measured alone. The time of each phase is the best of the repeated runs.
+# The results can be saved as JSON, and compared to the ones of a previous
+# run :
+#
+#   tools/benchmark.py -o baseline.json
+#   (change the converter)
+#   tools/benchmark.py -b baseline.json
+#
+# Nothing is downloaded, the generated manuals only depend on the options.
+
+import os
+import sys
+import imp
+import math
+import json
+import random
+import shutil
+import tempfile
+import textwrap
+import platform
+import subprocess
+
+from optparse import OptionParser, SUPPRESS_HELP
+
+PROJECT_HOME = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The converter imports its "parser" package, which must not be confused
+# with the python module of the same name
+sys.path.insert(0, PROJECT_HOME)
+dconv = imp.load_source('haproxy_dconv', os.path.join(PROJECT_HOME, 'haproxy-dconv.py'))
+
+WORDS = [
+    'accept', 'address', 'agent', 'backlog', 'balance', 'buffer', 'capture',
+    'check', 'client', 'compression', 'connect', 'cookie', 'delay', 'deny',
+    'domain', 'error', 'expect', 'forward', 'frontend', 'header', 'health',
+    'idle', 'inspect', 'interval', 'limit', 'log', 'mask', 'maximum',
+    'nodelay', 'persist', 'port', 'proxy', 'queue', 'rate', 'redirect',
+    'request', 'response', 'retry', 'rule', 'server', 'session', 'source',
+    'splice', 'ssl', 'stick', 'table', 'timeout', 'track', 'tunnel', 'uri',
+    'weight',
+]
+PREFIXES = ['', '', '', 'option ', 'timeout ', 'http-', 'tcp-', 'no option ']
+SECTIONS = ['defaults', 'frontend', 'listen', 'backend']
+
+# Scale 1 is a small manual, "-c" chapters and "-k" keywords are generated
+# for each unit of scale
+DEFAULT_SCALES = '1,10,100'
+DEFAULT_CHAPTERS = 8
+DEFAULT_KEYWORDS = 100
+
+# Phases under this duration are too short to be compared
+NOISE = 0.01
+
+def main():
+    usage="Usage: %prog [options] [manual ...]"
+
+    optparser = OptionParser(description='Measure the conversion of synthetic and given manuals',
+                          usage=usage)
+    optparser.add_option('--scales', '-s', default=DEFAULT_SCALES, help='Comma separated sizes of the generated manuals (default: %s)' % DEFAULT_SCALES)
+    optparser.add_option('--chapters', '-c', type='int', default=DEFAULT_CHAPTERS, help='Chapters per unit of scale (default: %d)' % DEFAULT_CHAPTERS)
+    optparser.add_option('--keywords', '-k', type='int', default=DEFAULT_KEYWORDS, help='Keywords per unit of scale (default: %d)' % DEFAULT_KEYWORDS)
+    optparser.add_option('--seed', type='int', default=0, help='Seed of the generated manuals')
+    optparser.add_option('--repeat', '-r', type='int', default=3, help='Conversions of each manual, the best one is kept (default: 3)')
+    optparser.add_option('--parsers', action='store_true', default=False, help='Also measure the time spent in each parser')
+    optparser.add_option('--generate', '-g', metavar='DIRECTORY', help='Only write the generated manuals in DIRECTORY')
+    optparser.add_option('--output', '-o', metavar='FILE', help='Write the results as JSON to FILE, or "-" for stdout')
+    optparser.add_option('--baseline', '-b', metavar='FILE', help='Compare the results to the ones saved in FILE')
+    optparser.add_option('--tolerance', '-t', type='float', default=0.2, help='Slowdown ratio reported as a regression (default: 0.2)')
+    optparser.add_option('--run', help=SUPPRESS_HELP)
+    optparser.add_option('--result', help=SUPPRESS_HELP)
+    (option, args) = optparser.parse_args()
+
+    if option.run:
+        # Child process, converting one manual
+        report = run(option.run, option.parsers)
+        with open(option.result, 'w') as fd:
+            json.dump(report, fd)
+        return
+
+    try:
+        scales = [int(scale) for scale in option.scales.split(',') if scale]
+    except ValueError:
+        optparser.error("invalid scales: %s" % option.scales)
+    if option.repeat < 1:
+        optparser.error("--repeat must be at least 1")
+
+    baseline = None
+    if option.baseline:
+        with open(option.baseline) as fd:
+            baseline = json.load(fd)
+
+    if option.generate:
+        fixtures = generate_fixtures(option.generate, scales, option.chapters, option.keywords, option.seed)
+        for name, path in fixtures:
+            print path
+        return
+
+    workdir = tempfile.mkdtemp(prefix='dconv-benchmark-')
+    try:
+        fixtures = generate_fixtures(workdir, scales, option.chapters, option.keywords, option.seed)
+        for path in args:
+            fixtures.append((os.path.basename(path), os.path.abspath(path)))
+        results = benchmark(fixtures, workdir, option.repeat, option.parsers)
+    finally:
+        shutil.rmtree(workdir)
+
+    report = {
+        'version': get_version(),
+        'python': platform.python_version(),
+        'repeat': option.repeat,
+        'chapters': option.chapters,
+        'keywords': option.keywords,
+        'seed': option.seed,
+        'order': [name for name, path in fixtures],
+        'results': results,
+    }
+
+    print_report(report)
+    if option.output:
+        if option.output == '-':
+            json.dump(report, sys.stdout, indent=1, sort_keys=True, separators=(',', ': '))
+            print
+        else:
+            with open(option.output, 'w') as fd:
+                json.dump(report, fd, indent=1, sort_keys=True, separators=(',', ': '))
+
+    if baseline is not None:
+        if compare(baseline, report, option.tolerance):
+            sys.exit(1)
+
+def get_version():
+    try:
+        p = subprocess.Popen(["git", "describe", "--tags", "--always", "--dirty"], cwd=PROJECT_HOME, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except EnvironmentError:
+        return None
+    version = p.communicate()[0].strip()
+    if p.returncode != 0:
+        return None
+    return version
+
+# Generate a manual for each scale, returning their names and paths
+def generate_fixtures(directory, scales, chapters, keywords, seed=0):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fixtures = []
+    for scale in scales:
+        name = "%dx" % scale
+        path = os.path.abspath(os.path.join(directory, "configuration-%s.txt" % name))
+        with open(path, 'w') as fd:
+            fd.write(generate_manual(chapters * scale, keywords * scale, seed))
+        fixtures.append((name, path))
+    return fixtures
+
+# Build a manual with the layout of configuration.txt : each chapter
+# introduces its keywords, lists them in a matrix then describes each one
+def generate_manual(chapters, keywords, seed=0):
+    rnd = random.Random(seed)
+    chapters = max(1, chapters)
+
+    names = []
+    known = set()
+    while len(names) < keywords:
+        name = rnd.choice(PREFIXES) + rnd.choice(WORDS)
+        if rnd.random() < 0.5:
+            name += '-' + rnd.choice(WORDS)
+        if name in known:
+            name += '-%d' % len(names)
+        known.add(name)
+        names.append(name)
+
+    groups = [names[i::chapters] for i in xrange(chapters)]
+    titles = [sentence(rnd, 2, 4)[:-1] for i in xrange(chapters)]
+
+    lines = []
+    lines.append("                             ----------------------")
+    lines.append("                                   HAProxy")
+    lines.append("                             Configuration Manual")
+    lines.append("                             ----------------------")
+    lines.append("                                 version 1.7")
+    lines.append("                                willy tarreau")
+    lines.append("                                  2016/11/25")
+    lines.append("")
+    lines.append("")
+    lines.extend(paragraph(rnd, names, chapters, 4))
+    lines.append("")
+    lines.append("")
+    lines.append("Summary")
+    lines.append("-------")
+    lines.append("")
+    for i in xrange(chapters):
+        lines.append("%-6s%s" % ("%d." % (i + 1), titles[i]))
+        lines.append("%-10s%s" % ("%d.1." % (i + 1), "Keywords matrix"))
+        lines.append("%-10s%s" % ("%d.2." % (i + 1), "Keywords reference"))
+    lines.append("")
+
+    for i in xrange(chapters):
+        lines.append("")
+        lines.extend(title("%d. %s" % (i + 1, titles[i])))
+        lines.append("")
+        for j in xrange(rnd.randint(2, 4)):
+            lines.extend(paragraph(rnd, names, chapters, rnd.randint(3, 8)))
+            lines.append("")
+        if rnd.random() < 0.5:
+            lines.extend(bullets(rnd, names))
+            lines.append("")
+        if rnd.random() < 0.5:
+            lines.extend(pipe_table(rnd))
+            lines.append("")
+
+        lines.append("")
+        lines.extend(title("%d.1. Keywords matrix" % (i + 1)))
+        lines.append("")
+        lines.extend(paragraph(rnd, names, chapters, 2))
+        lines.append("")
+        lines.extend(matrix(rnd, groups[i]))
+        lines.append("")
+
+        lines.append("")
+        lines.extend(title("%d.2. Keywords reference" % (i + 1)))
+        lines.append("")
+        lines.extend(paragraph(rnd, names, chapters, 2))
+        lines.append("")
+        for name in sorted(groups[i]):
+            lines.append("")
+            lines.extend(keyword(rnd, name, names))
+        lines.append("")
+
+    # The parsers expect some text after the last keyword
+    lines.append("")
+    lines.extend(paragraph(rnd, names, chapters, 3))
+    lines.append("")
+    return "\n".join(lines)
+
+def title(text):
+    return [text, "-" * len(text)]
+
+def sentence(rnd, low=6, high=14):
+    words = [rnd.choice(WORDS) for i in xrange(rnd.randint(low, high))]
+    return " ".join(words).capitalize() + "."
+
+# Some text referencing keywords and sections, as links are created for them
+def paragraph(rnd, names, chapters, count, indent=""):
+    sentences = []
+    for i in xrange(count):
+        text = sentence(rnd)
+        choice = rnd.random()
+        if names and choice < 0.4:
+            text = text[:-1] + ', see "%s".' % rnd.choice(names)
+        elif choice < 0.5:
+            text = text[:-1] + ", as explained in section %d.%d." % (rnd.randint(1, chapters), rnd.randint(1, 2))
+        sentences.append(text)
+    return textwrap.wrap(" ".join(sentences), 79 - len(indent), initial_indent=indent, subsequent_indent=indent)
+
+def bullets(rnd, names):
+    lines = []
+    for i in xrange(rnd.randint(3, 6)):
+        lines.append("  - %s" % rnd.choice(names or WORDS))
+    return lines
+
+def pipe_table(rnd):
+    separator = "    --------------------+------+---------------------------"
+    lines = ["    Criterion           | Type | Description", separator]
+    for i in xrange(rnd.randint(3, 8)):
+        lines.append("    %-19s | %-4s | %s" % (rnd.choice(WORDS) + "_" + rnd.choice(WORDS), rnd.choice(['ip', 'int', 'str', 'bool']), sentence(rnd, 2, 4)))
+    lines.append(separator)
+    return lines
+
+def matrix(rnd, group):
+    header = " keyword                              defaults   frontend   listen    backend"
+    separator = "------------------------------------+----------+----------+---------+---------"
+    lines = [header, separator]
+    for name in sorted(group):
+        flags = [rnd.choice(['X', 'X', '-']) for section in SECTIONS]
+        lines.append("%-42s%s          %s         %s         %s" % tuple([name] + flags))
+    lines.append(separator)
+    lines.append(header)
+    return lines
+
+def keyword(rnd, name, names):
+    arguments = ["<%s>" % rnd.choice(WORDS) for i in xrange(rnd.randint(0, 3))]
+    lines = []
+    signature = name
+    if arguments:
+        signature += " " + " ".join(arguments[:1] + ["[ %s ]" % argument for argument in arguments[1:]])
+    lines.append(signature)
+    if rnd.random() < 0.1:
+        lines.append("%s-old <%s> (deprecated)" % (name, rnd.choice(WORDS)))
+
+    lines.extend(textwrap.wrap(" ".join(sentence(rnd) for i in xrange(rnd.randint(1, 3))), 77, initial_indent="  ", subsequent_indent="  "))
+    usable = [rnd.choice(['yes', 'no']) for section in SECTIONS]
+    lines.append("  May be used in sections :   defaults | frontend | listen | backend")
+    lines.append(("                                 %-3s   |    %-3s   |   %-3s  |   %-3s" % tuple(usable)).rstrip())
+
+    if arguments:
+        lines.append("  Arguments :")
+        for argument in arguments:
+            text = textwrap.wrap(" ".join(sentence(rnd) for i in xrange(rnd.randint(1, 2))), 63)
+            lines.append("    %-9s %s" % (argument, text[0]))
+            for line in text[1:]:
+                lines.append("              %s" % line)
+            lines.append("")
+    else:
+        lines.append("  Arguments : none")
+        lines.append("")
+
+    if rnd.random() < 0.6:
+        lines.append("  Example :")
+        for i in xrange(rnd.randint(1, 4)):
+            lines.append("        %s %s" % (name, " ".join(rnd.choice(WORDS) for j in xrange(rnd.randint(1, 3)))))
+        lines.append("")
+
+    related = rnd.sample(names, min(len(names), rnd.randint(1, 5)))
+    see = ", ".join('"%s"' % other for other in related)
+    lines.extend(textwrap.wrap("See also : " + see, 77, initial_indent="  ", subsequent_indent="             "))
+    lines.append("")
+    return lines
+
+# Convert each manual several times in separate processes, keeping the best
+# measures
+def benchmark(fixtures, workdir, repeat=1, parsers=False):
+    results = {}
+    for name, path in fixtures:
+        reports = []
+        for i in xrange(repeat):
+            print >> sys.stderr, "%s: run %d/%d..." % (name, i + 1, repeat)
+            reports.append(run_child(path, workdir, parsers))
+        results[name] = summarize(reports)
+    return results
+
+def run_child(path, workdir, parsers=False):
+    result = os.path.join(workdir, 'result.json')
+    log = os.path.join(workdir, 'run.log')
+    command = [sys.executable, os.path.abspath(__file__), '--run', path, '--result', result]
+    if parsers:
+        command.append('--parsers')
+    # The converter reports each exported file, which is only shown on error
+    with open(log, 'w') as fd:
+        status = subprocess.call(command, stderr=fd)
+    if status != 0:
+        with open(log) as fd:
+            sys.stderr.write(fd.read())
+        print >> sys.stderr, "Unable to convert %s" % path
+        sys.exit(1)
+    with open(result) as fd:
+        return json.load(fd)
+
+# Entry point of the child processes
+def run(infile, parsers=False):
+    # Templates are looked up from the converter directory
+    os.chdir(PROJECT_HOME)
+
+    converter = dconv.Converter(get_version() or '', stats=parsers)
+    templates = converter.get_templates()
+    outdir = tempfile.mkdtemp(prefix='dconv-benchmark-')
+    try:
+        start = dconv.time.time()
+        converted = [converter.convert_file(infile, outdir)]
+        dconv.export_all(templates, converted)
+        elapsed = dconv.time.time() - start
+    finally:
+        shutil.rmtree(outdir)
+
+    report = dconv.get_stats_report(converted, elapsed, converter.version)
+    del report['files']
+    return report
+
+def summarize(reports):
+    result = {
+        'counters': reports[0]['counters'],
+        'time': min(report['time'] for report in reports),
+        'peak memory': min(report['peak memory'] for report in reports),
+    }
+    for table in ('phases', 'parsers'):
+        result[table] = {}
+        for name in reports[0][table]:
+            result[table][name] = min(report[table][name]['time'] for report in reports)
+    return result
+
+# Time of each stage for each manual, and how it grows with the number of
+# lines : 1 is linear, 2 is quadratic
+def print_report(report):
+    order = report['order']
+    results = report['results']
+
+    names = set()
+    for name in order:
+        names.update(results[name]['phases'])
+    rows = [('phase ' + name, lambda result, name=name: result['phases'].get(name)) for name in sorted(names)]
+    names = set()
+    for name in order:
+        names.update(results[name]['parsers'])
+    rows += [(name, lambda result, name=name: result['parsers'].get(name)) for name in sorted(names)]
+    rows.append(('total', lambda result: result['time']))
+
+    columns = "".join("%12s" % name[:11] for name in order)
+    print >> sys.stderr
+    print >> sys.stderr, "%-32s%s%10s" % ("Time (s)", columns, "growth")
+    print >> sys.stderr, "%-32s%s" % ("lines", "".join("%12d" % results[name]['counters'].get('lines', 0) for name in order))
+    print >> sys.stderr, "%-32s%s" % ("keywords", "".join("%12d" % results[name]['counters'].get('keywords', 0) for name in order))
+    for label, get in rows:
+        values = [get(results[name]) for name in order]
+        cells = "".join(value is None and "%12s" % "-" or "%12.3f" % value for value in values)
+        print >> sys.stderr, "%-32s%s%10s" % (label, cells, growth(order, results, values))
+    print >> sys.stderr, "%-32s%s" % ("peak memory (KB)", "".join("%12d" % results[name]['peak memory'] for name in order))
+
+# Exponent of the time against the number of lines, between the smallest and
+# the largest generated manuals
+def growth(order, results, values):
+    points = []
+    for name, value in zip(order, values):
+        lines = results[name]['counters'].get('lines', 0)
+        if name.endswith('x') and name[:-1].isdigit() and value and value >= NOISE and lines:
+            points.append((lines, value))
+    if len(points) < 2:
+        return ""
+    points.sort()
+    (lines1, time1), (lines2, time2) = points[0], points[-1]
+    if lines1 == lines2:
+        return ""
+    return "%.2f" % (math.log(time2 / time1) / math.log(float(lines2) / lines1))
+
+# Report the measures slower than the baseline by more than the tolerance,
+# returning True when there is a regression
+def compare(baseline, report, tolerance):
+    regressions = 0
+    print >> sys.stderr
+    print >> sys.stderr, "Compared to %s :" % (baseline.get('version') or "the baseline")
+    print >> sys.stderr, "%-12s %-32s %12s %12s %8s" % ("Manual", "Measure", "Baseline", "Current", "Ratio")
+    for name in report['order']:
+        if not name in baseline['results']:
+            continue
+        before = baseline['results'][name]
+        after = report['results'][name]
+        measures = [('total (s)', before['time'], after['time'])]
+        for table in ('phases', 'parsers'):
+            for key in sorted(after[table]):
+                if key in before.get(table, {}):
+                    measures.append(("%s (s)" % key, before[table][key], after[table][key]))
+        measures.append(('peak memory (KB)', before['peak memory'], after['peak memory']))
+
+        for measure, old, new in measures:
+            if not old or (measure.endswith('(s)') and old < NOISE and new < NOISE):
+                continue
+            ratio = float(new) / old
+            if ratio > 1 + tolerance:
+                state = "slower"
+                regressions += 1
+            elif ratio < 1 - tolerance:
+                state = "faster"
+            else:
+                state = ""
+            if measure.endswith('(s)'):
+                values = "%12.3f %12.3f" % (old, new)
+            else:
+                values = "%12d %12d" % (old, new)
+            print >> sys.stderr, "%-12s %-32s %s %8.2f %s" % (name[:12], measure, values, ratio, state)
+    if regressions:
+        print >> sys.stderr, "%d measure(s) above the tolerance of %d%%" % (regressions, tolerance * 100)
+    return regressions > 0
+
+if __name__ == '__main__':
+    main()
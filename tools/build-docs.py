@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2012 Cyril Bonté
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Build the documentation of several HAProxy versions in one run.
+#
+# The targets are listed in a JSON manifest, each one being an object with :
+# - "repository" : path to the HAProxy git repository,
+# - "url"        : optional, where to clone/fetch the repository from,
+# - "revision"   : revision to document (ex: "origin/master"),
+# - "stable"     : optional, document the last tag before the revision,
+# - "input"      : file to convert, as a path in the repository,
+# - "output"     : HTML file to produce,
+# - "base"       : optional, base directory for relative links,
+# - "index"/"tag": optional, HTML file where the version is updated between
+#                  the "<!-- tag -->" and "<!-- /tag -->" comments.
+# Relative paths are relative to the directory of the manifest.
+#
+# The files are read from the git objects, no checkout is done. Targets
+# sharing a repository, a revision and an output directory are converted
+# together, with a menu linking them. A target is only converted again when
+# its version differs from the one recorded at the end of the output file,
+# and only written if its content changed.
+
+import os
+import sys
+import imp
+import re
+import time
+import json
+import subprocess
+import multiprocessing
+
+from optparse import OptionParser
+
+PROJECT_HOME = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The converter imports its "parser" package, which must not be confused
+# with the python module of the same name
+sys.path.insert(0, PROJECT_HOME)
+dconv = imp.load_source('haproxy_dconv', os.path.join(PROJECT_HOME, 'haproxy-dconv.py'))
+
+def main():
+    usage="Usage: %prog [options] manifest"
+
+    optparser = OptionParser(description='Build the HAProxy documentation described in a manifest',
+                          usage=usage)
+    optparser.add_option('--jobs','-j', type='int', default=multiprocessing.cpu_count(), help='Number of files to convert in parallel')
+    optparser.add_option('--force','-f', action='store_true', default=False, help='Convert all the files, even those already up to date')
+    optparser.add_option('--fetch', action='store_true', default=False, help='Clone or fetch the repositories having an url first')
+    optparser.add_option('--changelog', help='File where to write a commit message describing the updated files')
+    optparser.add_option('--compact-anchors', action='store_true', default=False, help='Only write the anchor of each keyword, the other names leading to it being resolved by the page')
+    optparser.add_option('--lazy-keywords', action='store_true', default=False, help='Render the keywords list of the sidebar in the browser, only the keywords in view being in the page')
+    optparser.add_option('--compress', action='store_true', default=False, help='Also write each page compressed with gzip, and with brotli when its python module is installed')
+    optparser.add_option('--cache-directory', default=os.path.join(PROJECT_HOME, 'cache'), help='Directory to keep data across runs, empty to disable')
+    optparser.add_option('--cache-max-age', type='int', default=30, metavar='DAYS', help='Remove the sections of the cache not used for this number of days, 0 to keep them')
+    (option, args) = optparser.parse_args()
+
+    if len(args) != 1:
+        optparser.print_help()
+        exit(1)
+
+    targets = read_manifest(args[0])
+    if option.cache_directory:
+        option.cache_directory = os.path.abspath(option.cache_directory)
+    if option.changelog:
+        option.changelog = os.path.abspath(option.changelog)
+
+    if option.fetch:
+        fetch(targets)
+
+    # Templates are looked up from the converter directory
+    os.chdir(PROJECT_HOME)
+
+    version = dconv.get_git_version()
+    if not version:
+        sys.exit(1)
+
+    if option.cache_directory and option.cache_max_age > 0:
+        dconv.prune_cache(option.cache_directory, option.cache_max_age)
+
+    options = {
+        'compress': option.compress,
+        'compact_anchors': option.compact_anchors,
+        'lazy_keywords': option.lazy_keywords,
+    }
+    updated = build(targets, version, option.jobs, option.force, option.cache_directory, options)
+
+    if option.changelog:
+        with open(option.changelog, 'w') as fd:
+            fd.write(get_changelog(updated, version))
+
+    # The updated files, for the caller to commit them
+    for target in updated:
+        print target['output']
+
+def read_manifest(path):
+    with open(path) as fd:
+        targets = json.load(fd)
+
+    root = os.path.dirname(os.path.abspath(path))
+    for target in targets:
+        for key in target.keys():
+            if isinstance(target[key], unicode):
+                target[key] = target[key].encode('utf-8')
+        for key in ('repository', 'output', 'index'):
+            if key in target:
+                target[key] = os.path.join(root, target[key])
+        target.setdefault('base', '')
+        target.setdefault('stable', False)
+    return targets
+
+def fetch(targets):
+    fetched = set()
+    for target in targets:
+        path = target['repository']
+        if not target.get('url') or path in fetched:
+            continue
+        fetched.add(path)
+        if os.path.exists(path):
+            print >> sys.stderr, "Fetching %s..." % path
+            command = ["git", "fetch", "-v", "--tags", "origin"]
+            cwd = path
+        else:
+            print >> sys.stderr, "Cloning %s..." % target['url']
+            command = ["git", "clone", "-v", "--no-checkout", target['url'], path]
+            cwd = None
+        if subprocess.call(command, cwd=cwd) != 0:
+            sys.exit(1)
+
+# The options a page was produced with, as recorded next to its version
+def get_options_names(options):
+    return ",".join(sorted(name for name in options if options[name])) or "-"
+
+def get_trailer(version, options):
+    return "<!-- git:%s options:%s -->\n" % (version, get_options_names(options))
+
+# Return the version and the options recorded on the last line of a generated
+# file
+def get_built_version(outfile):
+    try:
+        with open(outfile, 'rb') as fd:
+            fd.seek(0, os.SEEK_END)
+            fd.seek(max(0, fd.tell() - 4096))
+            lastline = fd.read().rstrip("\n").rsplit("\n", 1)[-1]
+    except IOError:
+        return None
+    found = re.search(r' git:([^ ]*)(?: options:([^ ]*))?', lastline)
+    if found:
+        # Pages built before the options were recorded had none
+        return (found.group(1), found.group(2) or "-")
+    return None
+
+# Find the version and the content of each target, from the git objects
+def resolve(targets):
+    repositories = {}
+    try:
+        for target in targets:
+            path = target['repository']
+            if not path in repositories:
+                repositories[path] = dconv.GitRepository(path)
+            repository = repositories[path]
+
+            version = repository.describe(target['revision'])
+            if not version:
+                print >> sys.stderr, "Unable to describe %s in %s" % (target['revision'], path)
+                sys.exit(1)
+            if target['stable']:
+                version = re.sub(r'-[0-9]+-g[0-9a-f]+$', '', version)
+                revision = version
+            else:
+                revision = target['revision']
+
+            target['version'] = version
+            target['source'] = repository.read_file(revision, target['input'])
+            target['built'] = get_built_version(target['output'])
+    finally:
+        for repository in repositories.values():
+            repository.close()
+
+# Entry point of the worker processes
+def build_target(args):
+    version, cachedir, options, target = args
+    start = time.time()
+    converter = dconv.Converter(version, dconv.parse_git_version(target['version']), target['base'], cachedir, **options)
+    basefile, outfile, data = converter.convert_file(
+        target['input'],
+        os.path.dirname(target['output']),
+        target['source'],
+        os.path.basename(target['output']),
+    )
+    # The parser context holds the templates lookup, which can't be sent back
+    # to the parent process
+    del data['pctxt']
+    return ((basefile, outfile, data), time.time() - start)
+
+# options are given to the converter of each target, the pages built with
+# other options are converted again
+def build(targets, version, jobs=1, force=False, cachedir=None, options=None):
+    options = options or {}
+    resolve(targets)
+
+    groups = {}
+    for target in targets:
+        if target['source'] is None:
+            print >> sys.stderr, "%s: no %s in %s, skipped" % (target['output'], target['input'], target['version'])
+            continue
+        key = (target['repository'], target['version'], os.path.dirname(target['output']))
+        groups.setdefault(key, []).append(target)
+
+    # A group is converted again as a whole, as its files share a menu
+    pending = []
+    for key in sorted(groups):
+        group = groups[key]
+        if force or [target for target in group if target['built'] != (target['version'], get_options_names(options))]:
+            pending.append(group)
+        else:
+            for target in group:
+                print >> sys.stderr, "%s: already up to date (%s)" % (target['output'], target['version'])
+
+    tasks = [(version, cachedir, options, target) for group in pending for target in group]
+    if not tasks:
+        return []
+
+    for group in pending:
+        directory = os.path.dirname(group[0]['output'])
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    start = time.time()
+    results = []
+    updated = []
+    try:
+        if jobs > 1 and len(tasks) > 1:
+            pool = multiprocessing.Pool(min(jobs, len(tasks)))
+            try:
+                dconv.collect_results([pool.apply_async(build_target, (task,)) for task in tasks], results)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for task in tasks:
+                results.append(build_target(task))
+
+        templates = dconv.create_templates(cachedir)
+        remaining = iter(results)
+        for group in pending:
+            converted = []
+            for target in group:
+                result, elapsed = remaining.next()
+                target['time'] = elapsed
+                # Records the version and the options, for the next runs to
+                # know it's up to date
+                result[2]['trailer'] = get_trailer(target['version'], options)
+                target['options'] = get_options_names(options)
+                converted.append(result)
+
+            exportStart = time.time()
+            changed = dconv.export_all(templates, converted, cachedir, options.get('compress', False))
+            exportTime = (time.time() - exportStart) / len(group)
+
+            for target in group:
+                target['time'] += exportTime
+                target['changed'] = target['output'] in changed
+                if not target['changed']:
+                    continue
+                if target.get('index') and target.get('tag'):
+                    update_index(target['index'], target['tag'], re.sub(r'-g[0-9a-f]+$', '', target['version']))
+                updated.append(target)
+    finally:
+        dconv.remove_documents([result for result, elapsed in results])
+
+    print >> sys.stderr
+    for group in pending:
+        for target in group:
+            if target['changed']:
+                state = "changed"
+            else:
+                state = "unchanged"
+            print >> sys.stderr, "%-60s %-20s %-9s %6.2fs" % (target['output'], target['version'], state, target['time'])
+    print >> sys.stderr, "%d file(s) converted in %.2fs, %d changed" % (len(tasks), time.time() - start, len(updated))
+    return updated
+
+def update_index(index, tag, version):
+    with open(index) as fd:
+        content = fd.read()
+    updated = re.sub(
+        r'(<!-- %s -->)(.*)(<!-- /%s -->)' % (re.escape(tag), re.escape(tag)),
+        lambda match: match.group(1) + version + match.group(3),
+        content
+    )
+    if updated != content:
+        with open(index, 'w') as fd:
+            fd.write(updated)
+
+def get_changelog(updated, version):
+    if not updated:
+        return ""
+    changelog = "Updating HAProxy documentation generated by haproxy-dconv %s\n" % version
+    for target in updated:
+        if target['stable']:
+            state = "stable"
+        else:
+            state = "snapshot"
+        changelog += "\n%s %s %s\n" % (state, target['input'], re.sub(r'-g[0-9a-f]+$', '', target['version']))
+        if not target['built']:
+            continue
+        builtVersion, builtOptions = target['built']
+        if builtVersion != target['version']:
+            p = subprocess.Popen(["git", "log", "--oneline", "%s..%s" % (builtVersion, target['version']), "--", target['input']], cwd=target['repository'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            changelog += p.communicate()[0]
+        elif builtOptions != target['options']:
+            changelog += "rebuilt with new options\n"
+    return changelog
+
+if __name__ == '__main__':
+    main()
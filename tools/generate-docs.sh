@@ -66,95 +66,30 @@ function fetch_haproxy_dconv()
 	$GIT checkout gh-pages && $GIT pull -v
 }
 
-function fetch_haproxy()
+function generate_docs()
 {
-	url=$1
-	path=$2
+	docroot=$1
+	GITDOC="git-C $docroot"
 
-	echo "Fetching HAProxy 1.4 repository..."
-	if [ ! -e $path ];
+	if [ $UPDATED -eq 1 ];
 	then
-		git clone -v $url $path || exit 1
+		FORCE=--force
+	else
+		FORCE=
 	fi
-	GIT="git-C $path"
-
-	$GIT checkout master && $GIT pull -v
-}
-
-function _generate_file()
-{
-    infile=$1
-	destfile=$2
-	git_version=$3
-	state=$4
 
-	$GIT checkout $git_version
+	# Fetches the HAProxy repositories and converts the files listed in the
+	# manifest which are not up to date, in parallel
+	files=$($WORK_DIR/haproxy-dconv/master/tools/build-docs.py --fetch $FORCE --changelog $WORK_DIR/changelog $PROJECT_HOME/generate-docs.json) || exit 1
 
-	if [ -e $gitpath/doc/$infile ];
+	if [ "$files" != "" ];
 	then
-
-		git_version_simple=${git_version%-g*}
-		doc_version=$(tail -n1 $destfile 2>/dev/null | grep " git:" | sed 's/.* git:\([^ ]*\).*/\1/')
-		if [ $UPDATED -eq 1 -o "$git_version" != "$doc_version" ];
-		then
-			HTAG="VERSION-$(basename $gitpath | sed 's/[.]/\\&/g')"
-			if [ "$state" == "snapshot" ];
-			then
-				base=".."
-				HTAG="$HTAG-SNAPSHOT"
-			else
-				base="."
-			fi
-
-
-			$WORK_DIR/haproxy-dconv/master/haproxy-dconv.py -i $gitpath/doc/$infile -o $destfile --base=$base &&
-			echo "<!-- git:$git_version -->" >> $destfile &&
-			sed -i "s/\(<\!-- $HTAG -->\)\(.*\)\(<\!-- \/$HTAG -->\)/\1${git_version_simple}\3/" $docroot/index.html
-
-		else
-			echo "Already up to date."
-		fi
-
-		if [ "$doc_version" != "" -a "$git_version" != "$doc_version" ];
-		then
-			changelog=$($GIT log --oneline $doc_version..$git_version $gitpath/doc/$infile)
-		else
-			changelog=""
-		fi
-
-		GITDOC="git-C $docroot"
-		if [ "$($GITDOC status -s $destfile)" != "" ];
-		then
-			$GITDOC add $destfile &&
-			$GITDOC commit -m "Updating HAProxy $state $infile ${git_version_simple} generated by haproxy-dconv $version" -m "$changelog" $destfile $docroot/index.html &&
-			PUSH=1
-		fi
+		$GITDOC add $files $docroot/index.html &&
+		$GITDOC commit -F $WORK_DIR/changelog &&
+		PUSH=1
 	fi
 }
 
-function generate_docs()
-{
-	url=$1
-	gitpath=$2
-	docroot=$3
-    infile=$4
-	outfile=$5
-
-	fetch_haproxy $url $gitpath
-
-	GIT="git-C $gitpath"
-
-	$GIT checkout master
-	git_version=$($GIT describe --tags --match 'v*')
-	git_version_stable=${git_version%-*-g*}
-
-	echo "Generating snapshot version $git_version..."
-	_generate_file $infile $docroot/snapshot/$outfile $git_version snapshot
-
-	echo "Generating stable version $git_version..."
-	_generate_file $infile $docroot/$outfile $git_version_stable stable
-}
-
 function push()
 {
 	docroot=$1
@@ -171,13 +106,6 @@ function push()
 init
 fetch_haproxy_dconv
 
-generate_docs http://git.haproxy.org/git/haproxy-1.4.git/ $WORK_DIR/haproxy/1.4 $WORK_DIR/haproxy-dconv/gh-pages configuration.txt configuration-1.4.html
-generate_docs http://git.haproxy.org/git/haproxy-1.5.git/ $WORK_DIR/haproxy/1.5 $WORK_DIR/haproxy-dconv/gh-pages configuration.txt configuration-1.5.html
-
-generate_docs http://git.haproxy.org/git/haproxy-1.6.git/ $WORK_DIR/haproxy/1.6 $WORK_DIR/haproxy-dconv/gh-pages configuration.txt configuration-1.6.html
-generate_docs http://git.haproxy.org/git/haproxy-1.6.git/ $WORK_DIR/haproxy/1.6 $WORK_DIR/haproxy-dconv/gh-pages intro.txt intro-1.6.html
-
-generate_docs http://git.haproxy.org/git/haproxy.git/ $WORK_DIR/haproxy/1.7 $WORK_DIR/haproxy-dconv/gh-pages configuration.txt configuration-1.7.html
-generate_docs http://git.haproxy.org/git/haproxy.git/ $WORK_DIR/haproxy/1.7 $WORK_DIR/haproxy-dconv/gh-pages intro.txt intro-1.7.html
+generate_docs $WORK_DIR/haproxy-dconv/gh-pages
 
 push $WORK_DIR/haproxy-dconv/gh-pages